@@ -0,0 +1,5 @@
+"""
+Package: benchmarks
+
+Performance benchmarks for the payments service.
+"""
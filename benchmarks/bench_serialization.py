@@ -0,0 +1,110 @@
+"""
+Benchmark of JSON serialization for payment listings.
+
+Times GET /payments style listings three ways: Payment objects encoded by
+serialize() and the standard library json module (as before), rows from
+Payment.serialize_all() with the standard library, serialize_all() with
+the fastest JSON library installed, and Payment.encode_all(), which has
+Postgres build the JSON of each row. Then times the encoding alone with
+every JSON library installed.
+
+Run with:
+  python -m benchmarks.bench_serialization
+
+The payments table of DATABASE_URI is dropped and refilled, so it defaults
+to an in-memory SQLite database.
+"""
+import os
+import sys
+import json
+import time
+import logging
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+
+# pylint: disable=wrong-import-position
+from service.models import Payment, db
+from service.representations import (ENCODERS, JSON_LIBRARY, EncodedJSON,
+                                     dumps)
+from benchmarks.bench_validation import PAYMENTS
+
+# pylint: enable=wrong-import-position
+
+
+def seed(rows):
+    """Replaces the payments with rows new ones."""
+    Payment.disconnect()
+    Payment.remove_all()
+    payments = list(PAYMENTS.values())
+    Payment.save_all([
+        Payment().deserialize(payments[i % len(payments)])
+        for i in range(rows)
+    ])
+    Payment.disconnect()
+
+
+def best_time(function, repeat=5):
+    """Returns the best time of one call to function, in milliseconds."""
+    times = []
+    for _ in range(repeat):
+        Payment.disconnect()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1e3
+
+
+def listings():
+    """Returns the ways of listing every payment as JSON, by name."""
+    query = lambda: Payment.find_by(None, None, None, None)
+    return {
+        'objects+json':
+        lambda: json.dumps([payment.serialize() for payment in query()]),
+        'rows+json':
+        lambda: ENCODERS['json'](list(Payment.serialize_all(query()))),
+        'rows+' + JSON_LIBRARY:
+        lambda: dumps(list(Payment.serialize_all(query()))),
+        'encode_all':
+        lambda: EncodedJSON.array(
+            payment for _, payment in Payment.encode_all(query())).body,
+    }
+
+
+def encodings(results):
+    """Returns the ways of encoding a list of payments, slowest library first."""
+    functions = {}
+    for library, encode in reversed(list(ENCODERS.items())):
+        try:
+            encode(results[:1])
+        except AttributeError:
+            # The library is not installed.
+            continue
+        functions[library] = lambda encode=encode: encode(results)
+    return functions
+
+
+def report(title, times):
+    """Prints times against the first one."""
+    print(title)
+    baseline = next(iter(times.values()))
+    for name, elapsed in times.items():
+        speedup = baseline / elapsed
+        print('  {:<16} {:8.1f} ms  ({:.1f}x)'.format(name, elapsed, speedup))
+
+
+def main(rows=10000):
+    """Prints the time to list rows payments each way."""
+    Payment.logger.setLevel(logging.WARNING)
+    seed(rows)
+    report(
+        'Listing {} payments from {}'.format(rows, db.engine.url.drivername),
+        {name: best_time(function)
+         for name, function in listings().items()})
+    results = list(
+        Payment.serialize_all(Payment.find_by(None, None, None, None)))
+    report('Encoding {} payments'.format(rows),
+           {name: best_time(function)
+            for name, function in encodings(results).items()})
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
@@ -0,0 +1,56 @@
+"""
+Benchmark of payment schema validation.
+
+Compares the per-request cost of jsonschema.validate(), which checks the
+schema and builds a new validator on every call, with the validators that
+schemas.payment_schema compiles once at import time.
+
+Run with:
+  python -m benchmarks.bench_validation
+"""
+import timeit
+import jsonschema
+from schemas.payment_schema import PAYMENT_SCHEMA, validate_payment
+from tests.dummy_data import DUMMY
+
+PAYMENTS = {
+    'credit card': {
+        'order_id': 1,
+        'customer_id': 1,
+        'available': True,
+        'type': 'credit card',
+        'info': DUMMY
+    },
+    'paypal': {
+        'order_id': 2,
+        'customer_id': 2,
+        'available': True,
+        'type': 'paypal',
+        'info': {
+            'email': 'john@example.com',
+            'phone_number': '123456789',
+            'token': 'abc'
+        }
+    }
+}
+
+
+def per_call(function, number):
+    """Returns the best time of one call to function, in microseconds."""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main(number=2000):
+    """Prints the validation cost per payment before and after."""
+    for payment_type, payment in PAYMENTS.items():
+        before = per_call(
+            lambda data=payment: jsonschema.validate(data, PAYMENT_SCHEMA),
+            number)
+        after = per_call(lambda data=payment: validate_payment(data), number)
+        print('{:<12} jsonschema.validate {:8.1f} us  validate_payment '
+              '{:8.1f} us  ({:.1f}x)'.format(payment_type, before, after,
+                                             before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Load test for a running payments service.
+
+Runs a fixed number of concurrent clients against one endpoint for a while
+at each concurrency level, and prints how the request rate and latency
+change as clients are added. Compare worker classes by starting the
+service with different GUNICORN_WORKER_CLASS and WEB_CONCURRENCY values.
+
+Run with:
+  python -m benchmarks.loadtest --base-url http://localhost:5000 \\
+      --path /payments --clients 1,4,16,64 --duration 10
+"""
+import sys
+import time
+import argparse
+import threading
+import requests
+from tests.payments_factory import PaymentsFactory
+
+
+def seed(base_url, count):
+    """Creates payments to read back during the test."""
+    payments = [PaymentsFactory().serialize() for _ in range(count)]  # pylint: disable=no-member
+    for start in range(0, count, 1000):
+        resp = requests.post(
+            base_url + '/payments/batch', json=payments[start:start + 1000])
+        resp.raise_for_status()
+
+
+def client(url, deadline, latencies, errors):
+    """Sends requests one after another until the deadline."""
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            resp = session.get(url)
+            succeeded = resp.status_code < 400
+        except requests.RequestException:
+            succeeded = False
+        if succeeded:
+            latencies.append(time.monotonic() - start)
+        else:
+            errors.append(1)
+
+
+def run_level(url, clients, duration):
+    """Runs one concurrency level and returns its statistics."""
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + duration
+    workers = [
+        threading.Thread(
+            target=client, args=(url, deadline, latencies, errors))
+        for _ in range(clients)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    latencies.sort()
+    count = len(latencies)
+    return {
+        'clients': clients,
+        'requests_per_second': count / duration,
+        'p50_ms': latencies[count // 2] * 1000 if count else None,
+        'p99_ms': latencies[int(count * 0.99)] * 1000 if count else None,
+        'errors': len(errors)
+    }
+
+
+def format_ms(value):
+    """Formats a latency, or n/a when no request succeeded."""
+    return 'n/a' if value is None else '{:.1f}'.format(value)
+
+
+def main(argv=None):
+    """Parses the command line and runs every concurrency level."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--path', default='/payments')
+    parser.add_argument('--clients', default='1,2,4,8,16,32,64')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Create this many payments first')
+    args = parser.parse_args(argv)
+
+    if args.seed:
+        seed(args.base_url, args.seed)
+    print('{:>8} {:>10} {:>10} {:>10} {:>8}'.format(
+        'clients', 'req/s', 'p50 ms', 'p99 ms', 'errors'))
+    for clients in [int(value) for value in args.clients.split(',')]:
+        stats = run_level(args.base_url + args.path, clients, args.duration)
+        print('{:>8} {:>10.1f} {:>10} {:>10} {:>8}'.format(
+            stats['clients'], stats['requests_per_second'],
+            format_ms(stats['p50_ms']), format_ms(stats['p99_ms']),
+            stats['errors']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
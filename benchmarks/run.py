@@ -0,0 +1,268 @@
+"""
+Benchmark suite for the payments model layer and API.
+
+Seeds the database with payments made by tests.payments_factory, then
+times Payment.find, every combination of find_by filters, serialization,
+schema validation and the main endpoints through the Flask test client,
+at each database size. The results are written as JSON, and can be
+compared with the results of an earlier commit.
+
+Run with:
+  python -m benchmarks.run --sizes 1000,10000 --output after.json \\
+      --compare before.json
+
+The payments table of DATABASE_URI is dropped and refilled, so it defaults
+to an in-memory SQLite database. Seeding 10^6 payments takes minutes.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import itertools
+import platform
+import subprocess
+os.environ.setdefault('DATABASE_URI', 'sqlite://')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+# pylint: disable=wrong-import-position
+from service import app
+from service.models import Payment, db
+from schemas.payment_schema import validate_payment
+from tests.payments_factory import PaymentsFactory
+from benchmarks.bench_validation import PAYMENTS
+
+# pylint: enable=wrong-import-position
+
+# The find_by filters, and the field of a payment each one is taken from.
+FILTERS = (('customer_id', 'customer_id'), ('order_id', 'order_id'),
+           ('available', 'available'), ('payment_type', 'type'))
+
+# Payments written by one INSERT when seeding.
+SEED_BATCH_SIZE = 10000
+
+
+def seed(size):
+    """Replaces the payments with size new ones from PaymentsFactory."""
+    Payment.disconnect()
+    Payment.remove_all()
+    for start in range(0, size, SEED_BATCH_SIZE):
+        Payment.save_all([
+            PaymentsFactory()
+            for _ in range(min(SEED_BATCH_SIZE, size - start))
+        ])
+        Payment.disconnect()
+
+
+def measure(operation, runs, setup=None):
+    """Times runs calls of operation.
+
+    Args:
+        operation (callable): The code to time.
+        runs (int): The number of calls.
+        setup (callable): Called before each call and not timed. Returns
+            the arguments of the call.
+
+    Returns:
+        dict: The number of runs and the mean, median and 95th percentile
+            time of a call, in microseconds.
+    """
+    times = []
+    for _ in range(runs):
+        args = setup() if setup is not None else ()
+        start = time.perf_counter()
+        operation(*args)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {
+        'runs': runs,
+        'mean_us': sum(times) / runs * 1e6,
+        'p50_us': times[runs // 2] * 1e6,
+        'p95_us': times[int(runs * 0.95)] * 1e6
+    }
+
+
+def random_payment(size):
+    """Returns a random seeded payment in a new session."""
+    Payment.disconnect()
+    return Payment.find(random.randint(1, size))
+
+
+def model_benchmarks(size):
+    """Returns the model layer benchmarks, by name.
+
+    Each benchmark is an operation and the setup of its arguments.
+    """
+
+    def find_setup():
+        Payment.disconnect()
+        return (random.randint(1, size), )
+
+    benchmarks = {'Payment.find': (Payment.find, find_setup)}
+    for count in range(len(FILTERS) + 1):
+        for combination in itertools.combinations(FILTERS, count):
+
+            def find_by_setup(combination=combination):
+                payment = random_payment(size)
+                filters = dict.fromkeys(name for name, _ in FILTERS)
+                filters.update((name, getattr(payment, field))
+                               for name, field in combination)
+                Payment.disconnect()
+                return (filters, )
+
+            name = 'Payment.find_by[{}]'.format(','.join(
+                name for name, _ in combination))
+            benchmarks[name] = (
+                lambda filters: list(
+                    Payment.find_by(
+                        limit=app.config['DEFAULT_PAGE_SIZE'], **filters)),
+                find_by_setup)
+
+    def page_setup():
+        Payment.disconnect()
+        return (Payment.find_by(None, None, None, None,
+                                limit=app.config['DEFAULT_PAGE_SIZE']), )
+
+    benchmarks.update({
+        'Payment.serialize':
+        (lambda payment: payment.serialize(),
+         lambda: (random_payment(size), )),
+        'Payment.serialize_all[page]':
+        (lambda query: list(Payment.serialize_all(query)), page_setup),
+        'Payment.deserialize':
+        (lambda data: Payment().deserialize(data),
+         lambda: (random_payment(size).serialize(), )),
+    })
+    for payment_type, data in PAYMENTS.items():
+        benchmarks['validate_payment[{}]'.format(payment_type)] = (
+            validate_payment, lambda data=data: (data, ))
+    return benchmarks
+
+
+def endpoint_benchmarks(size):
+    """Returns the endpoint benchmarks through the test client, by name."""
+    client = app.test_client()
+    new_payment = lambda: (PaymentsFactory().serialize(), )  # pylint: disable=no-member
+
+    def payment_setup():
+        return (random_payment(size), )
+
+    return {
+        'GET /payments/<id>':
+        (lambda payment: client.get('/payments/{}'.format(payment.id)),
+         payment_setup),
+        'GET /payments':
+        (lambda: client.get('/payments'), None),
+        'GET /payments?customer_id':
+        (lambda payment: client.get(
+            '/payments', query_string={'customer_id': payment.customer_id}),
+         payment_setup),
+        'GET /payments/stats?group_by=type':
+        (lambda: client.get('/payments/stats?group_by=type'), None),
+        'POST /payments':
+        (lambda data: client.post('/payments', json=data), new_payment),
+        'PUT /payments/<id>':
+        (lambda payment, data: client.put(
+            '/payments/{}'.format(payment.id), json=data),
+         lambda: payment_setup() + new_payment()),
+        'PATCH /payments/<id>/toggle':
+        (lambda payment: client.patch(
+            '/payments/{}/toggle'.format(payment.id)), payment_setup),
+    }
+
+
+def run(sizes, runs):
+    """Runs every benchmark at each size and returns the results."""
+    results = {}
+    for size in sizes:
+        print('Seeding {} payments...'.format(size))
+        sys.stdout.flush()
+        seed(size)
+        benchmarks = model_benchmarks(size)
+        benchmarks.update(endpoint_benchmarks(size))
+        results[str(size)] = {}
+        for name, (operation, setup) in benchmarks.items():
+            stats = measure(operation, runs, setup)
+            results[str(size)][name] = stats
+            print('{:>8} {:<64} {:>10.1f} {:>10.1f}'.format(
+                size, name, stats['p50_us'], stats['p95_us']))
+            sys.stdout.flush()
+    return results
+
+
+def git_commit():
+    """Returns the commit being benchmarked, if it can be found."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Prints how each median changed since a baseline run.
+
+    Returns:
+        list: The benchmarks whose median grew by more than threshold.
+    """
+    regressions = []
+    for size, benchmarks in sorted(results.items(), key=lambda i: int(i[0])):
+        for name, stats in benchmarks.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            ratio = stats['p50_us'] / before['p50_us']
+            flag = ''
+            if ratio > threshold:
+                regressions.append('{} {}'.format(size, name))
+                flag = '  REGRESSION'
+            print('{:>8} {:<64} {:>10.1f} {:>10.1f} {:>7.2f}x{}'.format(
+                size, name, before['p50_us'], stats['p50_us'], ratio, flag))
+    return regressions
+
+
+def main(argv=None):
+    """Parses the command line, runs the suite and writes its results."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', default='1000,10000',
+                        help='Comma separated numbers of payments to seed')
+    parser.add_argument('--runs', type=int, default=200,
+                        help='Calls timed per benchmark and size')
+    parser.add_argument('--output', default='benchmark-results.json',
+                        help='Write the results to this JSON file')
+    parser.add_argument('--compare',
+                        help='Compare the medians with this results file')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='Median ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    print('{:>8} {:<64} {:>10} {:>10}'.format('size', 'benchmark', 'p50 us',
+                                              'p95 us'))
+    results = run([int(size) for size in args.sizes.split(',')], args.runs)
+    with open(args.output, 'w') as output:
+        json.dump({
+            'commit': git_commit(),
+            'database': db.engine.url.drivername,
+            'python': platform.python_version(),
+            'runs': args.runs,
+            'results': results
+        }, output, indent=2, sort_keys=True)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        print('{:>8} {:<64} {:>10} {:>10} {:>8}'.format(
+            'size', 'benchmark', 'before', 'after', 'ratio'))
+        regressions = compare(results, baseline['results'], args.threshold)
+        if regressions:
+            print('{} regressions since {}'.format(len(regressions),
+                                                   baseline.get('commit')))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
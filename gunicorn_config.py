@@ -0,0 +1,55 @@
+"""
+Gunicorn configuration for the payments service.
+
+Run with:
+  gunicorn --config=gunicorn_config.py service:app
+
+The worker model is read from the environment:
+  WEB_CONCURRENCY: The number of worker processes (default 1).
+  GUNICORN_WORKER_CLASS: sync, gthread, gevent or eventlet (default sync).
+  GUNICORN_THREADS: The number of threads of each gthread worker.
+  GUNICORN_WORKER_CONNECTIONS: The number of clients each gevent or
+      eventlet worker serves at once.
+  GUNICORN_TIMEOUT: Seconds before a silent worker is restarted.
+  METRICS_DIR: The directory the workers share their metrics through,
+      emptied when gunicorn starts.
+
+With gevent or eventlet workers a slow Postgres query only blocks its own
+greenlet, because psycopg2 is made cooperative in every worker.
+"""
+import os
+import glob
+
+# Gunicorn reads its settings from these lower case module names.
+# pylint: disable=invalid-name
+
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'sync')
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+# pylint: enable=invalid-name
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """Forgets the metrics of the workers of an earlier run."""
+    directory = os.getenv('METRICS_DIR')
+    if directory:
+        for path in glob.glob(os.path.join(directory, '*.json')):
+            os.remove(path)
+
+
+def post_fork(server, worker):  # pylint: disable=unused-argument
+    """Makes psycopg2 yield to other greenlets while it waits on Postgres."""
+    # The worker class actually running, which -k or --worker-class on the
+    # command line may have changed from the one above. Only import the
+    # green library it uses.
+    # pylint: disable=import-outside-toplevel
+    running = server.cfg.worker_class_str.lower()
+    if 'eventlet' in running:
+        from psycogreen.eventlet import patch_psycopg
+        patch_psycopg()
+    elif 'gevent' in running:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
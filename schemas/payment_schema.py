@@ -1,9 +1,13 @@
 """
 Schema for payments and documentation.
 
+The validators are compiled once, when this module is imported, instead of
+on every request.
 """
 
 from copy import deepcopy
+from jsonschema import Draft7Validator
+from jsonschema.exceptions import best_match
 
 PAYMENT_SCHEMA = {
     "title":
@@ -163,3 +167,109 @@ PAYMENT_SCHEMA_DOC['properties']['info'] = {
 PAYMENT_SCHEMA_DOC['required'] = [
     "order_id", "customer_id", "available", "type", "info"
 ]
+
+PAYMENT_BULK_UPDATE_SCHEMA = {
+    "title":
+    "payment bulk update",
+    "type":
+    "object",
+    "properties": {
+        "ids": {
+            "type": "array",
+            "items": {
+                "type": "integer",
+                "minimum": 0
+            },
+            "minItems": 1
+        },
+        "filter": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "order_id": PAYMENT_SCHEMA['properties']['order_id'],
+                "customer_id": PAYMENT_SCHEMA['properties']['customer_id'],
+                "available": PAYMENT_SCHEMA['properties']['available'],
+                "type": PAYMENT_SCHEMA['properties']['type']
+            },
+            "minProperties": 1
+        },
+        "set": {
+            "type": "object",
+            "additionalProperties": False,
+            "properties": {
+                "order_id": PAYMENT_SCHEMA['properties']['order_id'],
+                "customer_id": PAYMENT_SCHEMA['properties']['customer_id'],
+                "available": PAYMENT_SCHEMA['properties']['available']
+            },
+            "minProperties": 1
+        },
+        "toggle": {
+            "const": True
+        }
+    },
+    "additionalProperties":
+    False,
+    # Never update the whole table by accident.
+    "anyOf": [{
+        "required": ["ids"]
+    }, {
+        "required": ["filter"]
+    }],
+    "oneOf": [{
+        "required": ["set"]
+    }, {
+        "required": ["toggle"]
+    }]
+}
+
+
+def _schema_for_type(payment_type):
+    """Returns PAYMENT_SCHEMA with only the info branch of one payment type."""
+    schema = deepcopy(PAYMENT_SCHEMA)
+    del schema['allOf']
+    for branch in PAYMENT_SCHEMA['allOf']:
+        if branch['if']['properties']['type']['const'] == payment_type:
+            schema['properties']['info'] = branch['then']['properties']['info']
+    return schema
+
+
+Draft7Validator.check_schema(PAYMENT_SCHEMA)
+Draft7Validator.check_schema(PAYMENT_BULK_UPDATE_SCHEMA)
+PAYMENT_VALIDATOR = Draft7Validator(PAYMENT_SCHEMA)
+PAYMENT_TYPE_VALIDATORS = {
+    payment_type: Draft7Validator(_schema_for_type(payment_type))
+    for payment_type in PAYMENT_SCHEMA['properties']['type']['enum']
+}
+PAYMENT_BULK_UPDATE_VALIDATOR = Draft7Validator(PAYMENT_BULK_UPDATE_SCHEMA)
+
+
+def _validate(validator, data):
+    """Raises the most relevant ValidationError of data, if it has any."""
+    error = best_match(validator.iter_errors(data))
+    if error is not None:
+        raise error
+
+
+def validate_payment(data):
+    """Validates a payment against PAYMENT_SCHEMA.
+
+    Payments of a known type go straight to the validator for that type,
+    so the if/then branches of the other types are never evaluated.
+
+    Raises:
+        jsonschema.exceptions.ValidationError: The payment is not valid.
+    """
+    validator = PAYMENT_VALIDATOR
+    if isinstance(data, dict):
+        validator = PAYMENT_TYPE_VALIDATORS.get(
+            data.get('type'), PAYMENT_VALIDATOR)
+    _validate(validator, data)
+
+
+def validate_bulk_update(data):
+    """Validates a bulk update against PAYMENT_BULK_UPDATE_SCHEMA.
+
+    Raises:
+        jsonschema.exceptions.ValidationError: The update is not valid.
+    """
+    _validate(PAYMENT_BULK_UPDATE_VALIDATOR, data)
@@ -0,0 +1,486 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Bulk import and export of payments.
+
+Run with:
+  python -m service.bulk import payments.ndjson
+  python -m service.bulk export payments.csv
+  python -m service.bulk fingerprint
+
+Files hold one payment per line, as NDJSON in the format of the API, or as
+CSV with a header row and the info column as JSON. Imported payments are
+validated against PAYMENT_SCHEMA as they are read, and get new ids.
+
+On Postgres the payments are streamed through COPY FROM STDIN and
+COPY TO STDOUT, and an import is a single transaction. Other databases
+fall back to Payment.save_all, which commits each batch, and to
+Payment.serialize_all.
+
+The fingerprint command gives a fingerprint to the payments saved before
+payments had one, a batch per transaction.
+"""
+import io
+import os
+import sys
+import csv
+import json
+import time
+import logging
+import argparse
+import itertools
+import collections
+import multiprocessing
+import jsonschema
+from schemas.payment_schema import validate_payment
+from service import app
+from service.models import (Payment, DataValidationError, SERIALIZED_FIELDS,
+                            db)
+from service.representations import dumps
+
+FORMATS = ('ndjson', 'csv')
+
+# Payments saved per transaction when COPY cannot be used.
+DEFAULT_BATCH_SIZE = 10000
+
+# Characters a COPY reads at a time.
+COPY_BUFFER_SIZE = 1 << 16
+
+# Records each validation process checks at a time.
+CHECK_CHUNK_SIZE = 1000
+
+
+class BulkError(Exception):
+    """Used when a file cannot be imported."""
+
+
+class Throughput:  # pylint: disable=too-few-public-methods
+    """Counts the payments of an import or export and how long it took."""
+
+    def __init__(self):
+        self.rows = 0
+        self.invalid = 0
+        self.start = time.perf_counter()
+
+    def report(self, verb):
+        """Returns a line reporting the payments per second."""
+        elapsed = time.perf_counter() - self.start
+        line = '{} {} payments in {:.2f}s ({:.0f} payments/s)'.format(
+            verb, self.rows, elapsed, self.rows / elapsed if elapsed else 0)
+        if self.invalid:
+            line += ', skipped {} invalid'.format(self.invalid)
+        return line
+
+
+def _parse_bool(value):
+    """Parses a CSV boolean."""
+    lowered = value.strip().lower()
+    if lowered in ('true', 't', '1'):
+        return True
+    if lowered in ('false', 'f', '0'):
+        return False
+    return value
+
+
+def read_records(stream, file_format):
+    """Reads the records of a file, one per payment.
+
+    Yields:
+        tuple: The line number and the record: a line of NDJSON, or a
+            dictionary of CSV fields.
+    """
+    if file_format == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    else:
+        for line_number, line in enumerate(stream, 1):
+            if line.strip():
+                yield line_number, line
+
+
+def parse_record(record):
+    """Parses a record of read_records() into a payment dictionary.
+
+    Raises:
+        ValueError: The record is not valid JSON.
+    """
+    if isinstance(record, str):
+        return json.loads(record)
+    data = dict(record)
+    for field in ('order_id', 'customer_id'):
+        if (data.get(field) or '').strip().isdigit():
+            data[field] = int(data[field])
+    if data.get('available') is not None:
+        data['available'] = _parse_bool(data['available'])
+    if data.get('info'):
+        data['info'] = json.loads(data['info'])
+    return data
+
+
+def check_record(item):
+    """Parses and validates a record of read_records().
+
+    Returns:
+        tuple: The line number, the column values of the new payment and
+            None, or the line number, None and why the payment is not
+            valid.
+    """
+    line_number, record = item
+    try:
+        data = parse_record(record)
+        validate_payment(data)
+        values = Payment().deserialize(data).column_values()
+    except (ValueError, DataValidationError) as error:
+        return line_number, None, str(error)
+    except jsonschema.ValidationError as error:
+        return line_number, None, error.message
+    values['version'] = 1
+    return line_number, values, None
+
+
+def check_chunk(chunk):
+    """Checks a list of records in a validation process."""
+    return [check_record(item) for item in chunk]
+
+
+def checked_records(records, jobs=1):
+    """Checks records with check_record(), in order, as they stream past.
+
+    Validating and deserializing take most of the time of an import, so
+    with more than one job the records are checked in chunks by a pool of
+    processes.
+    Only a few chunks per process are read ahead of the COPY, so files of
+    any size stream in constant memory.
+
+    Args:
+        records (iterable): The (line number, record) of each payment.
+        jobs (int): The number of validation processes.
+    """
+    if jobs <= 1:
+        for item in records:
+            yield check_record(item)
+        return
+    records = iter(records)
+    chunks = iter(lambda: list(itertools.islice(records, CHECK_CHUNK_SIZE)),
+                  [])
+    with multiprocessing.Pool(jobs) as pool:
+        pending = collections.deque()
+        for chunk in itertools.islice(chunks, 2 * jobs):
+            pending.append(pool.apply_async(check_chunk, (chunk, )))
+        while pending:
+            results = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(check_chunk, (chunk, )))
+            yield from results
+
+
+def valid_rows(checked, throughput, skip_invalid=False):
+    """Returns the column values of the valid checked records of a file.
+
+    Args:
+        checked (iterable): The results of check_record().
+        throughput (Throughput): Counts the valid and invalid payments.
+        skip_invalid (bool): Skip invalid payments instead of stopping.
+
+    Yields:
+        dict: The column values of each valid payment.
+
+    Raises:
+        BulkError: A payment is not valid and skip_invalid is False.
+    """
+    for line_number, values, error in checked:
+        if error is not None:
+            message = 'Line {}: {}'.format(line_number, error)
+            if not skip_invalid:
+                raise BulkError(message)
+            app.logger.warning(message)  # pylint: disable=no-member
+            throughput.invalid += 1
+            continue
+        throughput.rows += 1
+        yield values
+
+
+class CopyReader(io.TextIOBase):
+    """Reads the column values of payments as the CSV rows of a COPY.
+
+    Args:
+        rows (iterable): The column values of each payment.
+        columns (list): The columns of each row, in order.
+    """
+
+    def __init__(self, rows, columns):
+        super().__init__()
+        self.rows = iter(rows)
+        self.columns = columns
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.pending = ''
+        self.error = None
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        """Returns about size characters of rows, or '' at the end."""
+        size = COPY_BUFFER_SIZE if size is None or size < 0 else size
+        while len(self.pending) < size:
+            try:
+                values = next(self.rows, None)
+            except BulkError as error:
+                # The driver only reports that read() failed.
+                self.error = error
+                raise
+            if values is None:
+                break
+            values['info'] = dumps(values['info']).decode('utf-8')
+            self.writer.writerow([values[column] for column in self.columns])
+            self.pending += self.buffer.getvalue()
+            self.buffer.seek(0)
+            self.buffer.truncate()
+        data, self.pending = self.pending[:size], self.pending[size:]
+        return data
+
+
+def _quote(name):
+    """Quotes a table or column name for the database."""
+    return db.engine.dialect.identifier_preparer.quote(name)
+
+
+def copy_in(rows):
+    """Saves payments with one COPY FROM STDIN in a single transaction.
+
+    Args:
+        rows (iterable): The column values of each payment.
+    """
+    table = Payment.__table__
+    columns = [column.name for column in table.columns if column.name != 'id']
+    statement = 'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+        _quote(table.name), ', '.join(_quote(column) for column in columns))
+    reader = CopyReader(rows, columns)
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(statement, reader, COPY_BUFFER_SIZE)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        if reader.error is not None:
+            raise reader.error
+        raise
+    finally:
+        connection.close()
+
+
+def save_in_batches(rows, batch_size):
+    """Saves payments with Payment.save_all, a batch at a time.
+
+    Args:
+        rows (iterable): The column values of each payment.
+        batch_size (int): The payments saved per transaction.
+    """
+    batch = []
+    for values in rows:
+        batch.append(Payment(**values))
+        if len(batch) >= batch_size:
+            Payment.save_all(batch)
+            Payment.disconnect()
+            batch = []
+    Payment.save_all(batch)
+    Payment.disconnect()
+
+
+def import_payments(stream, file_format='ndjson', skip_invalid=False,
+                    batch_size=DEFAULT_BATCH_SIZE, jobs=1):
+    """Imports the payments of a file.
+
+    Args:
+        stream (file): The file, opened as text.
+        file_format (str): 'ndjson' or 'csv'.
+        skip_invalid (bool): Skip invalid payments instead of stopping.
+        batch_size (int): The payments saved per transaction when COPY
+            cannot be used.
+        jobs (int): The number of processes that validate payments.
+
+    Returns:
+        Throughput: The number of payments imported and skipped.
+
+    Raises:
+        BulkError: A payment is not valid and skip_invalid is False. No
+            payment is imported on Postgres.
+    """
+    throughput = Throughput()
+    rows = valid_rows(
+        checked_records(read_records(stream, file_format), jobs), throughput,
+        skip_invalid)
+    if db.engine.dialect.name == 'postgresql':
+        copy_in(rows)
+    else:
+        save_in_batches(rows, batch_size)
+    return throughput
+
+
+def _export_query(file_format):
+    """Returns the COPY TO STDOUT that exports payments in a format."""
+    table = _quote(Payment.__table__.name)
+    if file_format == 'csv':
+        return 'COPY (SELECT {} FROM {} ORDER BY id) TO STDOUT ' \
+            'WITH (FORMAT csv, HEADER)'.format(
+                ', '.join(_quote(field) for field in SERIALIZED_FIELDS), table)
+    # One JSON document per row. Control characters never appear unescaped
+    # in JSON, so CSV with them as quote and delimiter copies it verbatim.
+    pairs = ', '.join("'{}', {}".format(field, _quote(field))
+                      for field in SERIALIZED_FIELDS)
+    return "COPY (SELECT json_build_object({}) FROM {} ORDER BY id) " \
+        "TO STDOUT WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')" \
+        .format(pairs, table)
+
+
+def copy_out(stream, file_format):
+    """Writes every payment with one COPY TO STDOUT.
+
+    Returns:
+        int: The number of payments written.
+    """
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.copy_expert(_export_query(file_format), stream,
+                           COPY_BUFFER_SIZE)
+        connection.commit()
+        return cursor.rowcount
+    finally:
+        connection.close()
+
+
+def write_serialized(stream, file_format, batch_size):
+    """Writes every payment with Payment.serialize_all.
+
+    Returns:
+        int: The number of payments written.
+    """
+    query = Payment.query.order_by(Payment.id)
+    rows = 0
+    if file_format == 'csv':
+        writer = csv.writer(stream, lineterminator='\n')
+        writer.writerow(SERIALIZED_FIELDS)
+    for result in Payment.serialize_all(query, batch_size):
+        if file_format == 'csv':
+            result['info'] = json.dumps(result['info'])
+            writer.writerow(
+                [str(result[field]).lower() if isinstance(result[field], bool)
+                 else result[field] for field in SERIALIZED_FIELDS])
+        else:
+            stream.write(dumps(result).decode('utf-8') + '\n')
+        rows += 1
+    Payment.disconnect()
+    return rows
+
+
+def export_payments(stream, file_format='ndjson',
+                    batch_size=DEFAULT_BATCH_SIZE):
+    """Exports every payment, in order of id.
+
+    Args:
+        stream (file): The file, opened as text.
+        file_format (str): 'ndjson' or 'csv'.
+        batch_size (int): The rows fetched at a time when COPY cannot be
+            used.
+
+    Returns:
+        Throughput: The number of payments exported.
+    """
+    throughput = Throughput()
+    if db.engine.dialect.name == 'postgresql':
+        throughput.rows = copy_out(stream, file_format)
+    else:
+        throughput.rows = write_serialized(stream, file_format, batch_size)
+    return throughput
+
+
+def fingerprint_payments(batch_size=DEFAULT_BATCH_SIZE):
+    """Fingerprints every payment that has no fingerprint yet.
+
+    Returns:
+        Throughput: The number of payments that got a fingerprint.
+    """
+    throughput = Throughput()
+    throughput.rows = Payment.backfill_fingerprints(batch_size)
+    Payment.disconnect()
+    return throughput
+
+
+def guess_format(path):
+    """Returns the format of a file from its extension."""
+    return 'csv' if path.lower().endswith('.csv') else 'ndjson'
+
+
+def main(argv=None):
+    """Parses the command line and runs an import, export or backfill."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('command', choices=('import', 'export', 'fingerprint'))
+    parser.add_argument(
+        'path', nargs='?',
+        help="The file to read or write ('-' imports from STDIN)")
+    parser.add_argument('--format', choices=FORMATS,
+                        help='The format of the file (default: from the '
+                        'extension, else ndjson)')
+    parser.add_argument('--skip-invalid', action='store_true',
+                        help='Skip invalid payments instead of stopping')
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help='Payments per transaction without COPY, and '
+                        'per fingerprint batch')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Processes that validate payments (default: one '
+                        'per CPU)')
+    args = parser.parse_args(argv)
+    app.logger.setLevel(logging.WARNING)  # pylint: disable=no-member
+
+    if args.command == 'fingerprint':
+        throughput = fingerprint_payments(args.batch_size)
+        print(throughput.report('Fingerprinted'), file=sys.stderr)
+        return 0
+
+    if args.path is None:
+        parser.error('{} needs a file'.format(args.command))
+    file_format = args.format or guess_format(args.path)
+
+    if args.command == 'export':
+        if args.path == '-':
+            parser.error('export needs a file, the service logs to STDOUT')
+        with open(args.path, 'w', encoding='utf-8', newline='') as stream:
+            throughput = export_payments(stream, file_format, args.batch_size)
+        print(throughput.report('Exported'), file=sys.stderr)
+        return 0
+
+    stream = (sys.stdin if args.path == '-' else open(
+        args.path, encoding='utf-8', newline=''))
+    try:
+        throughput = import_payments(stream, file_format, args.skip_invalid,
+                                     args.batch_size, args.jobs)
+    except BulkError as error:
+        print('Import failed: {}'.format(error), file=sys.stderr)
+        return 1
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    print(throughput.report('Imported'), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,243 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Caches for Payment Service.
+
+Caches map a key to a JSON compatible value and count their hits and misses.
+
+A value read from the database is cached with add(), and a key is
+invalidated after its row is written. Invalidating leaves a tombstone for
+tombstone_ttl seconds, and add() never replaces an entry or a tombstone, so
+a read that started before a write cannot put the old row back in the
+cache once the write has invalidated it. A read that took longer than the
+tombstone lives is not cached at all.
+
+Caches
+------
+LRUCache: Keeps the most recently used entries in this process. Only use it
+    with a single worker: writes in one worker cannot invalidate the entries
+    cached by another.
+SharedCache: Keeps entries in a backend that every worker shares, such as
+    Redis, so an invalidation is seen by all of them.
+DictBackend: A stand-in for a Redis client that keeps values in a dict.
+"""
+import json
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:  # pragma: no cover
+    redis = None  # pylint: disable=invalid-name
+
+
+class LRUCache:
+    """An in-process least recently used cache with expiring entries."""
+
+    def __init__(self, maxsize=1024, ttl=60, tombstone_ttl=5):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value cached for a key, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic() or entry[1] is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        """Caches a value, evicting the least recently used entry if full."""
+        with self._lock:
+            self._put(key, value, self.ttl)
+
+    def add(self, key, value, read_at):
+        """Caches a value read from the database, unless the key has an entry.
+
+        Args:
+            key (str): The key of the value.
+            value: The value, or None to cache nothing.
+            read_at (float): The time.monotonic() before the value was read.
+        """
+        now = time.monotonic()
+        if value is None or now - read_at >= self.tombstone_ttl:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                self._put(key, value, self.ttl)
+
+    def invalidate(self, key):
+        """Removes the entry for a key and leaves a tombstone in its place."""
+        with self._lock:
+            self._put(key, None, self.tombstone_ttl)
+
+    def _put(self, key, value, ttl):
+        """Stores an entry, evicting the least recently used entry if full."""
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """Removes the entry for a key."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the hit, miss and size counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries)
+        }
+
+
+class SharedCache:
+    """A cache kept in a backend shared by every worker.
+
+    Args:
+        backend: A Redis client, or anything with the same get, set,
+            delete and scan_iter methods.
+        ttl (int): Seconds before an entry expires.
+        prefix (str): Prepended to every key in the backend.
+        tombstone_ttl (int): Seconds before the tombstone of an invalidated
+            key expires.
+    """
+
+    def __init__(self, backend, ttl=60, prefix='payments:', tombstone_ttl=5):
+        self.backend = backend
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Returns the value cached for a key, or None."""
+        raw = self.backend.get(self.prefix + key)
+        value = json.loads(raw) if raw is not None else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        """Caches a value until it expires."""
+        self.backend.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+
+    def add(self, key, value, read_at):
+        """Caches a value read from the database, unless the key has an entry.
+
+        The backend only sets the key if it is missing, so a tombstone left
+        by another worker is never replaced.
+
+        Args:
+            key (str): The key of the value.
+            value: The value, or None to cache nothing.
+            read_at (float): The time.monotonic() before the value was read.
+        """
+        if value is None or time.monotonic() - read_at >= self.tombstone_ttl:
+            return
+        self.backend.set(
+            self.prefix + key, json.dumps(value), ex=self.ttl, nx=True)
+
+    def invalidate(self, key):
+        """Replaces the entry for a key with a tombstone."""
+        self.backend.set(self.prefix + key, 'null', ex=self.tombstone_ttl)
+
+    def delete(self, key):
+        """Removes the entry for a key."""
+        self.backend.delete(self.prefix + key)
+
+    def clear(self):
+        """Removes every entry with this cache's prefix."""
+        for key in self.backend.scan_iter(self.prefix + '*'):
+            self.backend.delete(key)
+
+    def stats(self):
+        """Returns the hit and miss counters of this worker."""
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class DictBackend:
+    """A stand-in for a Redis client that keeps its values in a dict."""
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key):
+        """Returns the value of a key, or None if it is missing or expired."""
+        entry = self._values.get(key)
+        if entry is None or (entry[0] and entry[0] < time.monotonic()):
+            return None
+        return entry[1]
+
+    def set(self, key, value, ex=None, nx=False):
+        """Sets the value of a key, expiring after ex seconds if given.
+
+        With nx, the key is only set if it is missing.
+        """
+        if nx and self.get(key) is not None:
+            return None
+        self._values[key] = (time.monotonic() + ex if ex else None, value)
+        return True
+
+    def delete(self, *keys):
+        """Removes keys."""
+        for key in keys:
+            self._values.pop(key, None)
+
+    def scan_iter(self, match):
+        """Yields the keys that start with the prefix of a '*' pattern."""
+        prefix = match.rstrip('*')
+        for key in list(self._values):
+            if key.startswith(prefix):
+                yield key
+
+
+def create_cache(config):
+    """Creates the cache described by an app's configuration.
+
+    Returns None when CACHE_TYPE is 'none', so that nothing is cached.
+    """
+    cache_type = config['CACHE_TYPE']
+    if cache_type == 'none':
+        return None
+    if cache_type == 'local':
+        return LRUCache(config['CACHE_SIZE'], config['CACHE_TTL'])
+    if cache_type == 'redis':
+        if redis is None:
+            raise RuntimeError('CACHE_TYPE redis needs the redis package')
+        backend = redis.Redis.from_url(config['CACHE_REDIS_URL'])
+        return SharedCache(backend, config['CACHE_TTL'])
+    raise RuntimeError('Unknown CACHE_TYPE {}'.format(cache_type))
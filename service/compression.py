@@ -0,0 +1,118 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Response compression for Payment Service.
+
+compress_response() is an after_request function that compresses the
+response with the best encoding the client accepts: brotli, when the
+brotli package is installed, or gzip. Responses smaller than
+COMPRESS_MIN_SIZE are sent as they are. Streamed responses are compressed
+a chunk at a time, and each chunk is flushed so that the client can start
+decoding before the stream ends.
+"""
+import zlib
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None  # pylint: disable=invalid-name
+
+# Media types worth compressing.
+COMPRESSIBLE_MIMETYPES = frozenset(
+    ('application/json', 'application/x-ndjson', 'text/plain', 'text/html'))
+
+
+def supported_encodings():
+    """Returns the encodings that can be used, most preferred first."""
+    encodings = [
+        encoding.strip()
+        for encoding in current_app.config['COMPRESS_ENCODINGS'].split(',')
+    ]
+    return [
+        encoding for encoding in encodings
+        if encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+    ]
+
+
+def make_compressor(encoding):
+    """Makes the functions that compress a response with an encoding.
+
+    Returns:
+        tuple: A function that compresses some data, one that flushes the
+            data compressed so far, and one that ends the compressed data.
+    """
+    config = current_app.config
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config['COMPRESS_BR_LEVEL'])
+        return compressor.process, compressor.flush, compressor.finish
+    compressor = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush)
+
+
+def compress_chunks(chunks, compressor, charset='utf-8'):
+    """Compresses the chunks of a streamed response as they are made.
+
+    Args:
+        chunks (iterable): The chunks of the response.
+        compressor (tuple): The functions make_compressor() returns.
+        charset (str): Encodes the chunks that are strings.
+    """
+    compress, flush, finish = compressor
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compress(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        # Let a stream_with_context generator clean up its request context.
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def compress_response(response):
+    """Compresses a response if the client accepts it and it is big enough."""
+    if (response.status_code < 200 or response.status_code in (204, 304)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(supported_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # The chunks are made once this request has returned, so the
+        # compressor is made now, while the app config can still be read.
+        response.response = compress_chunks(response.response,
+                                            make_compressor(encoding),
+                                            response.charset)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+            return response
+        compress, _, finish = make_compressor(encoding)
+        response.set_data(compress(data) + finish())
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,113 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Logging helpers for Payment Service.
+
+Request threads only put their log records on a queue. A QueueListener
+thread takes them off the queue and writes them, so a slow STDOUT never
+holds up a request.
+"""
+import atexit
+import queue
+import random
+import logging
+from logging.handlers import QueueHandler, QueueListener
+
+# The queue handler and listener of each logger, by logger name.
+_LISTENERS = {}
+
+
+class SamplingFilter(logging.Filter):  # pylint: disable=too-few-public-methods
+    """Keeps only a fraction of the INFO and DEBUG records.
+
+    Args:
+        rate (float): The fraction of records to keep, from 0 to 1.
+            WARNING and above are always kept.
+    """
+
+    def __init__(self, rate=1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return (record.levelno > logging.INFO or self.rate >= 1
+                or random.random() < self.rate)
+
+
+def parse_levels(spec):
+    """Parses per logger levels such as 'service.models=WARNING,sqlalchemy=INFO'.
+
+    Returns:
+        dict: The level name of each logger name.
+    """
+    levels = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, separator, level = item.partition('=')
+        if not separator or not name.strip() or not level.strip():
+            raise ValueError('Invalid log level {!r}'.format(item))
+        levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def set_levels(spec):
+    """Sets the level of each logger named in a LOG_LEVELS string."""
+    for name, level in parse_levels(spec).items():
+        logging.getLogger(name).setLevel(level)
+
+
+def start_queue_logging(logger, handler, sample_rate=1.0):
+    """Sends the records of a logger through a queue to a handler.
+
+    A listener started before for the same logger is stopped first, once it
+    has written the records still on its queue.
+
+    Args:
+        logger (Logger): The logger whose records are queued.
+        handler (Handler): Writes the records on the listener thread.
+        sample_rate (float): The fraction of INFO and DEBUG records kept.
+
+    Returns:
+        QueueHandler: The handler added to the logger.
+    """
+    stop_queue_logging(logger)
+    log_queue = queue.Queue(-1)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(sample_rate))
+    logger.addHandler(queue_handler)
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    _LISTENERS[logger.name] = (queue_handler, listener)
+    return queue_handler
+
+
+def stop_queue_logging(logger=None):
+    """Writes the queued records and stops the listener threads.
+
+    Args:
+        logger (Logger): Only stop the listener of this logger.
+    """
+    names = [logger.name] if logger is not None else list(_LISTENERS)
+    for name in names:
+        if name in _LISTENERS:
+            queue_handler, listener = _LISTENERS.pop(name)
+            logging.getLogger(name).removeHandler(queue_handler)
+            listener.stop()
+
+
+atexit.register(stop_queue_logging)
@@ -0,0 +1,377 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Prometheus style metrics for Payment Service.
+
+Counters and histograms are updated without taking a lock: every thread
+records into its own shard, and the shards are only merged when the
+metrics are rendered for a scrape.
+
+Each gunicorn worker process keeps its own metrics. When they are shared
+through a directory (see share()), every worker writes its counters and
+histograms to a file there at most once per interval, and a scrape adds up
+the files of every worker, so it sees the same totals whichever worker
+answers. The files of stopped workers are kept, so totals never go down
+while the service runs. Gauges are those of the worker that answers, with
+its pid as a worker label.
+
+Metrics
+-------
+REQUEST_SECONDS: Latency of each route, by endpoint, method and status.
+DB_QUERY_SECONDS: Duration of each SQL statement, by statement type.
+VALIDATION_SECONDS: Duration of each JSON schema validation, by schema.
+"""
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    # Greenlets of one OS thread can share a shard, because they never
+    # switch in the middle of an update.
+    from gevent.monkey import get_original
+    _ThreadLocal = get_original('threading', 'local')  # pylint: disable=invalid-name
+except ImportError:  # pragma: no cover
+    _ThreadLocal = threading.local  # pylint: disable=invalid-name
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# Every metric rendered by render(), in order.
+REGISTRY = []
+
+# The directory the workers share their metrics through, or None.
+SHARED = None
+
+
+def _format_labels(labelnames, labels, extra=''):
+    """Formats label values as a Prometheus label set."""
+    pairs = [
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', r'\\').replace('"', r'\"').replace(
+                '\n', r'\n')) for name, value in zip(labelnames, labels)
+    ]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    """Formats a sample value."""
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _ShardedMetric:
+    """A metric whose values are kept in one dict per thread."""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = _ThreadLocal()
+        self._shards = []
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _shard(self):
+        """Returns the calling thread's shard, making it on first use."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def _snapshots(self):
+        """Returns a copy of every shard."""
+        with self._lock:
+            shards = list(self._shards)
+        return [shard.copy() for shard in shards]
+
+    def _all_shards(self):
+        """Returns a copy of every shard, and those of the other workers."""
+        shards = self._snapshots()
+        if SHARED is not None:
+            shards.extend(SHARED.shards(self.name))
+        return shards
+
+    def clear(self):
+        """Resets every shard."""
+        for shard in list(self._shards):
+            shard.clear()
+
+    def samples(self):
+        """Returns the merged (suffix, label values, extra, value) samples."""
+        raise NotImplementedError
+
+    def render(self):
+        """Renders the metric in the Prometheus text format."""
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.kind)
+        ]
+        for suffix, labels, extra, value in self.samples():
+            lines.append('{}{}{} {}'.format(
+                self.name, suffix,
+                _format_labels(self.labelnames, labels, extra),
+                _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_ShardedMetric):
+    """A count that only goes up."""
+
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        """Adds to the count of some label values."""
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """Returns the merged count of some label values."""
+        return sum(shard.get(labels, 0) for shard in self._snapshots())
+
+    def samples(self):
+        totals = {}
+        for shard in self._all_shards():
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        return [('', labels, '', value)
+                for labels, value in sorted(totals.items())]
+
+
+class Histogram(_ShardedMetric):
+    """Counts observations in cumulative buckets, with their sum."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        """Records one observation for some label values."""
+        shard = self._shard()
+        entry = shard.get(labels)
+        if entry is None:
+            # One count per bucket, one for +Inf, then the sum.
+            entry = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(self.buckets, value)] += 1
+        entry[-1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """Observes how long the body of a with statement takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def count(self, labels=()):
+        """Returns the merged number of observations of some label values."""
+        return sum(
+            sum(shard[labels][:-1]) for shard in self._snapshots()
+            if labels in shard)
+
+    def samples(self):
+        totals = {}
+        for shard in self._all_shards():
+            for labels, entry in shard.items():
+                total = totals.setdefault(labels, [0] * len(entry))
+                for i, value in enumerate(list(entry)):
+                    total[i] += value
+        samples = []
+        for labels, total in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'), ),
+                                    total[:-1]):
+                cumulative += count
+                samples.append(('_bucket', labels,
+                                'le="{}"'.format(_format_value(bound)),
+                                cumulative))
+            samples.append(('_sum', labels, '', total[-1]))
+            samples.append(('_count', labels, '', cumulative))
+        return samples
+
+
+class StatsGauges:  # pylint: disable=too-few-public-methods
+    """Gauges read from a dict of numbers each time metrics are rendered.
+
+    Args:
+        prefix (str): Prepended to every key of the dict.
+        documentation (str): Help text for the gauges.
+        stats (callable): Returns the dict of numbers.
+    """
+
+    def __init__(self, prefix, documentation, stats):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.stats = stats
+        REGISTRY.append(self)
+
+    def render(self):
+        """Renders one gauge per numeric value of the dict."""
+        lines = []
+        for key, value in sorted(self.stats().items()):
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            name = '{}_{}'.format(self.prefix, key)
+            labels = ''
+            if SHARED is not None:
+                labels = _format_labels(('worker', ), (os.getpid(), ))
+            lines.append('# HELP {} {}'.format(name, self.documentation))
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{}{} {}'.format(name, labels, _format_value(value)))
+        return '\n'.join(lines)
+
+
+class SharedDirectory:
+    """Shares the counters and histograms of every worker through files.
+
+    Args:
+        directory (str): The directory, which every worker can write to.
+        interval (float): The least seconds between two writes of a worker.
+    """
+
+    def __init__(self, directory, interval=1.0):
+        self.directory = directory
+        self.interval = interval
+        self._last_write = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, force=False):
+        """Writes this worker's metrics, unless it did so within interval.
+
+        Args:
+            force (bool): Write even if the last write was recent.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_write < self.interval:
+            return
+        # A request that finds another one writing skips its turn.
+        if not self._lock.acquire(blocking=force):
+            return
+        try:
+            self._last_write = now
+            data = {
+                metric.name: [[list(labels), value]
+                              for shard in metric._snapshots()  # pylint: disable=protected-access
+                              for labels, value in shard.items()]
+                for metric in REGISTRY if isinstance(metric, _ShardedMetric)
+            }
+            path = os.path.join(self.directory, '{}.json'.format(os.getpid()))
+            with open(path + '.tmp', 'w') as stream:
+                json.dump(data, stream)
+            # Readers only ever see a complete file.
+            os.replace(path + '.tmp', path)
+        finally:
+            self._lock.release()
+
+    def shards(self, name):
+        """Returns the shards of a metric written by the other workers."""
+        own = '{}.json'.format(os.getpid())
+        shards = []
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith('.json') or filename == own:
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as stream:
+                    data = json.load(stream)
+            except (OSError, ValueError):
+                continue
+            shards.append({
+                tuple(labels): value
+                for labels, value in data.get(name, ())
+            })
+        return shards
+
+
+def share(directory, interval=1.0):
+    """Shares the metrics of every worker through a directory.
+
+    Args:
+        directory (str): The directory, or '' to keep metrics per worker.
+        interval (float): The least seconds between two writes of a worker.
+    """
+    global SHARED  # pylint: disable=global-statement
+    SHARED = SharedDirectory(directory, interval) if directory else None
+
+
+def render():
+    """Renders every registered metric in the Prometheus text format."""
+    if SHARED is not None:
+        SHARED.write(force=True)
+    return '\n'.join(
+        text for text in (metric.render() for metric in REGISTRY) if text) + '\n'
+
+
+REQUEST_SECONDS = Histogram('payments_request_duration_seconds',
+                            'Time spent handling a request.',
+                            ('endpoint', 'method', 'status'))
+DB_QUERY_SECONDS = Histogram('payments_db_query_duration_seconds',
+                             'Time spent running a SQL statement.',
+                             ('statement', ))
+VALIDATION_SECONDS = Histogram('payments_schema_validation_duration_seconds',
+                               'Time spent validating a JSON document.',
+                               ('schema', ))
+
+
+# SQLAlchemy passes every listener the same arguments.
+# pylint: disable=too-many-arguments, unused-argument
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    """Notes when a statement starts."""
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Observes how long a statement took, by its first keyword."""
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    keyword = statement.split(None, 1)[0].upper()
+    DB_QUERY_SECONDS.observe(elapsed, (keyword, ))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    """Forgets the start of a statement that failed."""
+    if context.connection is not None:
+        starts = context.connection.info.get('query_start')
+        if starts:
+            starts.pop()
+
+
+# pylint: enable=too-many-arguments, unused-argument
@@ -22,6 +22,7 @@ All of the models are stored in this module.
 Models
 ------
 Payment: A payment used by a customer.
+IdempotencyKey: The response to a POST /payments with an Idempotency-Key.
 
 Attributes
 -----------
@@ -29,20 +30,125 @@ order_id (Integer): The order for which the payment was used.
 customer_id (Integer): The customer associated with a payment.
 available (boolean): True for payments that are available to pay.
 payment_type: The type of the payment. Currently, can be credit card or Paypal.
+info (JSON): The details of the payment; JSONB with a GIN index on Postgres.
+version (Integer): Counts the changes to a payment, starting at 1.
+fingerprint (String): A keyed hash of the card number, or of the paypal
+    email or token, that finds the payments of the same card.
 
 """
+# pylint: disable=too-many-lines
+
+import hmac
+import time
+import hashlib
 import logging
-from flask_sqlalchemy import SQLAlchemy
+import itertools
+from datetime import datetime, timedelta
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import (DDL, Text, and_, bindparam, cast, event, func,
+                        literal_column, not_, select, type_coerce)
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import Select
+from sqlalchemy.orm import make_transient_to_detached
+from service.cache import LRUCache, create_cache
+from service.pool import InstrumentedQueuePool, QUEUE_POOL_OPTIONS
+from service.representations import dumps
+
+
+# Picks the read replica of each new session, round robin.
+_REPLICA_COUNTER = itertools.count()
+
+
+def reads_from_primary():
+    """Checks whether reads must go to the primary database.
+
+    They must outside of a request, and in a request that writes or comes
+    from a client that wrote recently (see g.read_from_primary).
+    """
+    return not has_request_context() or g.get('read_from_primary', True)
+
+
+class RoutingSession(SignallingSession):
+    """A session that sends reads to a read replica.
+
+    The replicas are the SQLALCHEMY_BINDS named in READ_REPLICA_BINDS. Each
+    session reads from one replica, the next one round robin, so that a
+    request sees a single replica. Writes, flushes and anything that is not
+    a SELECT go to the primary database.
+    """
+
+    def __init__(self, db, **options):  # pylint: disable=redefined-outer-name
+        super().__init__(db, **options)
+        self.database = db
+        self.replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.config['READ_REPLICA_BINDS']
+        if (replicas and isinstance(clause, Select) and not self._flushing
+                and not reads_from_primary()):
+            if self.replica is None:
+                self.replica = replicas[next(_REPLICA_COUNTER) % len(replicas)]
+            return self.database.get_engine(self.app, bind=self.replica)
+        return super().get_bind(mapper, clause)
+
+
+class PaymentsSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy with instrumented pools and read replica routing."""
+
+    def create_session(self, options):
+        """Makes RoutingSessions."""
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        """Creates an engine with an InstrumentedQueuePool.
+
+        SQLite files get no connection queue, so the queue sizing options
+        are dropped for them.
+        """
+        if sa_url.drivername == 'sqlite':
+            for name in QUEUE_POOL_OPTIONS:
+                engine_opts.pop(name, None)
+        else:
+            engine_opts.setdefault('poolclass', InstrumentedQueuePool)
+        return super().create_engine(sa_url, engine_opts)
+
 
 # Create the SQLAlchemy object to be initialized later in init_db().
-db = SQLAlchemy()  # pylint: disable=invalid-name
+db = PaymentsSQLAlchemy()  # pylint: disable=invalid-name
+
+
+# The fields of a serialized payment, in order.
+SERIALIZED_FIELDS = ('id', 'order_id', 'customer_id', 'available', 'type',
+                     'info', 'version', 'fingerprint')
+
+# The fields that payments can be counted by.
+GROUP_BY_FIELDS = ('type', 'available', 'customer_id')
+
+# The fields of info that payments can be listed by.
+INFO_FILTER_FIELDS = ('email', 'token')
 
 
 class DataValidationError(Exception):
     """Used for data validation errors when deserializing."""
 
 
-class Payment(db.Model):
+def _cache_key(payment_id):
+    """Returns the cache key of a payment id, or None if it is not a number."""
+    try:
+        return str(int(payment_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def _supports_returning():
+    """Checks whether the database can return rows from INSERT and UPDATE."""
+    return db.engine.dialect.name == 'postgresql'
+
+
+class Payment(db.Model):  # pylint: disable=too-many-public-methods
     """
     Represents a payment.
 
@@ -50,8 +156,13 @@ class Payment(db.Model):
     from us by SQLAlchemy's object relational mappings (ORM).
     """
 
-    logger = logging.getLogger('flask.app')
+    # A child of the app logger, so its records are queued with the app's.
+    logger = logging.getLogger('service.models')
     app = None
+    # Read-through cache used by find(), or None to always read the database.
+    cache = None
+    # The HMAC key of the fingerprints, set by init_db().
+    fingerprint_key = b''
 
     # Table Schema
 
@@ -62,7 +173,27 @@ class Payment(db.Model):
     customer_id = db.Column(db.Integer)
     type = db.Column(db.String(50))
     available = db.Column(db.Boolean())
-    info = db.Column(db.JSON)
+    info = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'))
+    version = db.Column(db.Integer, nullable=False, default=1)
+    fingerprint = db.Column(db.String(64))
+
+    # Indexes for the filter combinations find_by() emits. Every query is
+    # ordered by id for keyset pagination, so id trails the composite
+    # indexes to keep the rows of a customer (or type) in cursor order.
+    __table_args__ = (
+        db.Index('ix_payment_customer_id_available', customer_id, available,
+                 id),
+        db.Index('ix_payment_order_id', order_id),
+        db.Index('ix_payment_fingerprint', fingerprint, id),
+        db.Index('ix_payment_type_available', type, available, id),
+        # Most listings only want the payments that can still be used, and
+        # the rest only those that cannot.
+        # pylint: disable=singleton-comparison
+        db.Index(
+            'ix_payment_available_id', id, postgresql_where=available == True),
+        db.Index('ix_payment_unavailable_id', id,
+                 postgresql_where=available == False),
+    )
 
     # pylint: enable=no-member
 
@@ -75,12 +206,18 @@ class Payment(db.Model):
 
         # pylint: disable=no-member
 
-        if not self.id:
+        created = not self.id
+        if created:
             db.session.add(self)
+        else:
+            self.version = Payment.version + 1
         db.session.commit()
 
         # pylint: enable=no-member
 
+        if not created:
+            Payment.uncache(self.id)
+
     def delete(self):
         """Removes a payment from the data store."""
         Payment.logger.info('Deleting %s', self.id)
@@ -92,6 +229,20 @@ class Payment(db.Model):
 
         # pylint: enable=no-member
 
+        Payment.uncache(self.id)
+
+    def column_values(self, with_id=False):
+        """Returns the values of a payment's columns.
+
+        Args:
+            with_id (bool): Whether to include the id.
+        """
+        return {
+            column.name: getattr(self, column.name)
+            for column in self.__table__.columns
+            if with_id or column.name != 'id'
+        }
+
     def serialize(self):
         """Serializes a payment into a dictionary."""
         return {
@@ -100,9 +251,75 @@ class Payment(db.Model):
             "customer_id": self.customer_id,
             "available": self.available,
             "type": self.type,
-            "info": self.info
+            "info": self.info,
+            "version": self.version,
+            "fingerprint": self.fingerprint
         }
 
+    @classmethod
+    def serialize_all(cls, query, batch_size=None, fields=SERIALIZED_FIELDS):
+        """Serializes the payments of a query into dictionaries.
+
+        Only the requested columns are selected and no Payment objects are
+        made, so this is much cheaper than serialize() for long lists.
+
+        Args:
+            query (Query): A query for payments, such as find_by() returns.
+            batch_size (int): Fetch the rows this many at a time.
+            fields (tuple): The names of the fields to serialize.
+
+        Returns:
+            iterator: The dictionary of each payment.
+        """
+        columns = [getattr(cls, name) for name in fields]
+        rows = query.with_entities(*columns)
+        if batch_size is not None:
+            rows = rows.yield_per(batch_size)
+        return (dict(zip(fields, row)) for row in rows)
+
+    @classmethod
+    def encode_all(cls, query, batch_size=None, fields=SERIALIZED_FIELDS):
+        """Encodes the payments of a query as JSON objects.
+
+        On Postgres, row_to_json makes the JSON text of each payment in the
+        database, so neither a dictionary nor an encoder call is needed per
+        row. Other databases fall back to serialize_all() and dumps().
+
+        Args:
+            query (Query): A query for payments ordered by id, such as
+                find_by() returns.
+            batch_size (int): Fetch the rows this many at a time.
+            fields (tuple): The names of the fields to serialize.
+
+        Returns:
+            iterator: The id and the UTF-8 JSON object of each payment.
+        """
+        # pylint: disable=no-member
+        bind = db.session.get_bind(clause=query.statement)
+        if bind.dialect.name != 'postgresql':
+            return ((values['id'], dumps(values))
+                    for values in cls.serialize_all(query, batch_size, fields))
+        rows = query.with_entities(
+            *[getattr(cls, name) for name in fields]).subquery('payment_row')
+        statement = select([
+            rows.c.id,
+            cast(func.row_to_json(literal_column(rows.name)), Text)
+        ]).order_by(rows.c.id)
+        if batch_size is not None:
+            statement = statement.execution_options(stream_results=True)
+        result = db.session.execute(statement)
+        return cls._encoded_rows(result, batch_size or 1000)
+
+    @staticmethod
+    def _encoded_rows(result, batch_size):
+        """Yields the (id, UTF-8 JSON) of the rows of encode_all()."""
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                return
+            for payment_id, text in rows:
+                yield payment_id, text.encode('utf-8')
+
     def deserialize(self, data):
         """Deserializes a payment from a dictionary.
 
@@ -115,6 +332,7 @@ class Payment(db.Model):
             self.available = data['available']
             self.type = data['type']
             self.info = data['info']
+            self.fingerprint = self.make_fingerprint(self.type, self.info)
         except KeyError as error:
             raise DataValidationError('Invalid payments: missing ' +
                                       error.args[0])
@@ -123,19 +341,94 @@ class Payment(db.Model):
                 'Invalid payments: body of request contained bad or no data')
         return self
 
+    @classmethod
+    def make_fingerprint(cls, payment_type, info):
+        """Makes the fingerprint of a payment method.
+
+        The fingerprint is an HMAC-SHA256 of the digits of the card number of
+        a credit card, or of the lower-cased email (else the token) of a
+        paypal account, so equal cards get equal fingerprints without the
+        card number being stored in an index.
+
+        Returns:
+            str: The hex digest, or None if the payment has nothing to hash.
+        """
+        if not isinstance(info, dict):
+            return None
+        if payment_type == 'credit card':
+            value = ''.join(
+                c for c in str(info.get('credit_card_number', ''))
+                if c.isdigit())
+        elif payment_type == 'paypal':
+            value = (str(info.get('email') or '').strip().lower()
+                     or str(info.get('token') or ''))
+        else:
+            return None
+        if not value:
+            return None
+        message = '{}:{}'.format(payment_type, value).encode('utf-8')
+        return hmac.new(cls.fingerprint_key, message,
+                        hashlib.sha256).hexdigest()
+
     @classmethod
     def init_db(cls, app):
         """Initializes the database session."""
         cls.logger.info('Initializing database')
         cls.app = app
+        cls.fingerprint_key = app.config['FINGERPRINT_KEY'].encode('utf-8')
 
         # This is where we initialize SQLAlchemy from the Flask app.
         db.init_app(app)
+        cls.cache = create_cache(app.config)
+        IdempotencyKey.init_cache(app.config)
         app.app_context().push()
 
         # Make our SQLAlchemy tables.
         db.create_all()
 
+    @classmethod
+    def save_all(cls, payments, commit=True):
+        """Saves many new payments in a single transaction.
+
+        On Postgres the new ids are taken from the id sequence first, one per
+        payment, and the payments are written with their ids by one
+        multi-row INSERT. Postgres does not promise to return the rows of an
+        INSERT ... RETURNING in VALUES order, so the ids are never matched
+        to the payments by position. New payments start at version 1.
+
+        Args:
+            payments (list): The new payments to save.
+            commit (bool): Commit the transaction. Otherwise the payments
+                are only written, and have their ids.
+        """
+        cls.logger.info('Saving %s payments', len(payments))
+        if not payments:
+            return payments
+
+        # pylint: disable=no-member
+
+        if db.engine.dialect.name == 'postgresql':
+            ids = db.session.execute(
+                "SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+                "FROM generate_series(1, :count)", {
+                    'table': cls.__table__.name,
+                    'count': len(payments)
+                }).fetchall()
+            for payment, row in zip(payments, ids):
+                payment.id = row[0]
+                payment.version = 1
+            db.session.execute(cls.__table__.insert().values(
+                [payment.column_values(with_id=True) for payment in payments]))
+        else:
+            db.session.add_all(payments)
+            db.session.flush()
+        if commit:
+            db.session.commit()
+
+        # pylint: enable=no-member
+
+        return payments
+
     @classmethod
     def all(cls):
         """Returns all of the payments in the database."""
@@ -154,6 +447,10 @@ class Payment(db.Model):
         db.drop_all()
         cls.logger.info('Recreating all the tables')
         db.create_all()
+        if cls.cache is not None:
+            cls.cache.clear()
+        if IdempotencyKey.cache is not None:
+            IdempotencyKey.cache.clear()
 
     @classmethod
     def find(cls, payments_id):
@@ -163,7 +460,87 @@ class Payment(db.Model):
             payment_id (int): The payment ID number.
         """
         cls.logger.info('Processing lookup for id %s ...', payments_id)
-        return cls.query.get(payments_id)
+        key = _cache_key(payments_id) if cls.cache is not None else None
+        if key is None:
+            return cls.query.get(payments_id)
+
+        # With read replicas, a request that must read from the primary
+        # skips the cache. Only rows read from the primary are cached, since
+        # a lagging replica would put an old row in front of every client,
+        # so a miss that would read a replica reads the primary instead.
+        replicas = bool(cls.app.config['READ_REPLICA_BINDS'])
+        values = None
+        if not (replicas and reads_from_primary() and has_request_context()):
+            values = cls.cache.get(key)
+        if values is not None:
+            return cls._attach(values)
+        read_at = time.monotonic()
+        if replicas and not reads_from_primary():
+            payment = cls._find_on_primary(payments_id)
+        else:
+            payment = cls.query.get(payments_id)
+        if payment is not None:
+            # A concurrent write may have invalidated the key since the row
+            # was read; add() leaves its tombstone in place.
+            cls.cache.add(key, payment.column_values(with_id=True), read_at)
+        return payment
+
+    @classmethod
+    def _find_on_primary(cls, payment_id):
+        """Finds a payment on the primary database, whatever the request."""
+        table = cls.__table__
+        row = db.session.execute(  # pylint: disable=no-member
+            table.select().where(table.c.id == payment_id),
+            bind=db.get_engine(cls.app)).first()
+        return cls._attach(dict(row)) if row is not None else None
+
+    @classmethod
+    def find_fields(cls, payment_id, fields):
+        """Finds some fields of a payment by its ID number.
+
+        Only those columns are read, and the cache is not used.
+
+        Args:
+            payment_id (int): The payment ID number.
+            fields (tuple): The names of the fields to serialize.
+
+        Returns:
+            dict: The serialized fields, or None if there is no such payment.
+        """
+        cls.logger.info('Processing lookup of %s for id %s ...', fields,
+                        payment_id)
+        query = cls.query.filter(cls.id == payment_id)
+        return next(cls.serialize_all(query, fields=fields), None)
+
+    @classmethod
+    def _attach(cls, values):
+        """Makes a payment in the session from its column values.
+
+        No SELECT is run, but the payment can still be saved or deleted.
+
+        Args:
+            values (dict): The value of every column, including the id.
+        """
+        payment = cls(**values)
+        make_transient_to_detached(payment)
+        return db.session.merge(payment, load=False)  # pylint: disable=no-member
+
+    @classmethod
+    def uncache(cls, *payment_ids):
+        """Drops payments from the cache after they are changed.
+
+        Each key keeps a tombstone for a few seconds, so that a find() that
+        read the row before the change cannot cache the old values.
+
+        Args:
+            payment_ids (int): The payment ID numbers.
+        """
+        if cls.cache is None:
+            return
+        for payment_id in payment_ids:
+            key = _cache_key(payment_id)
+            if key is not None:
+                cls.cache.invalidate(key)
 
     @classmethod
     def find_by_customer(cls, customer_id):
@@ -202,18 +579,495 @@ class Payment(db.Model):
         return cls.query.filter(cls.type == payment_type)
 
     @classmethod
-    def find_by(cls, customer_id, order_id, available, payment_type):
-        """Find payments using multiple filters."""
-        cls.logger.info(
-            'Processing query for customer_id %s, order_id %s,'
-            ' available %s, type %s ...', customer_id, order_id, available,
-            payment_type)
-        arg_list = [customer_id, order_id, available, payment_type]
+    def _filters(cls,  # pylint: disable=too-many-arguments
+                 customer_id=None,
+                 order_id=None,
+                 available=None,
+                 payment_type=None,
+                 info=None,
+                 fingerprint=None):
+        """Returns the filter clauses for the given field values."""
+        arg_list = [customer_id, order_id, available, payment_type, fingerprint]
         filter_list = [
             cls.customer_id == customer_id, cls.order_id == order_id,
-            cls.available == available, cls.type == payment_type
+            cls.available == available, cls.type == payment_type,
+            cls.fingerprint == fingerprint
         ]
-        filter_args = [
+        filters = [
             filter_list[i] for i, val in enumerate(arg_list) if val is not None
         ]
-        return cls.query.filter(*filter_args)
+        if info:
+            filters.append(cls._info_filter(info))
+        return filters
+
+    @classmethod
+    def _info_filter(cls, info):
+        """Returns the clause matching payments whose info has these values.
+
+        On Postgres this is a JSONB containment (info @> ...), which the GIN
+        index on info answers. Other databases compare each value extracted
+        from the JSON, row by row.
+
+        Args:
+            info (dict): The value of each info key to match.
+        """
+        if db.engine.dialect.name == 'postgresql':
+            # The column's comparator is the generic JSON one, which has no
+            # containment operator.
+            return type_coerce(cls.info, JSONB).contains(info)
+        return and_(*(cls.info[key].as_string() == value
+                      for key, value in info.items()))
+
+    @classmethod
+    def backfill_fingerprints(cls, batch_size=1000):
+        """Fingerprints the payments saved before they had fingerprints.
+
+        The payments without a fingerprint are read in order of id, a batch
+        at a time, and each batch is updated in its own transaction. A
+        payment that got a fingerprint in the meantime is left as it is.
+
+        Args:
+            batch_size (int): The payments read and updated at a time.
+
+        Returns:
+            int: The number of payments that got a fingerprint.
+        """
+        cls.logger.info('Backfilling fingerprints')
+        table = cls.__table__
+        statement = table.update().where(
+            and_(table.c.id == bindparam('payment_id'),
+                 table.c.fingerprint.is_(None))).values(
+                     fingerprint=bindparam('new_fingerprint'),
+                     version=table.c.version + 1)
+        after_id = 0
+        updated = 0
+
+        # pylint: disable=no-member
+
+        while True:
+            rows = db.session.execute(
+                table.select().with_only_columns(
+                    [table.c.id, table.c.type, table.c.info]).where(
+                        and_(table.c.fingerprint.is_(None),
+                             table.c.id > after_id)).order_by(
+                                 table.c.id).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            after_id = rows[-1].id
+            params = []
+            for row in rows:
+                fingerprint = cls.make_fingerprint(row.type, row.info)
+                if fingerprint is not None:
+                    params.append({
+                        'payment_id': row.id,
+                        'new_fingerprint': fingerprint
+                    })
+            if params:
+                updated += db.session.execute(statement, params).rowcount
+            db.session.commit()
+            cls.uncache(*(item['payment_id'] for item in params))
+
+        # pylint: enable=no-member
+
+        return updated
+
+    @classmethod
+    def update_all(cls, changes, ids=None, filters=None):
+        """Applies the same changes to many payments with one UPDATE.
+
+        Args:
+            changes (dict): The new value of each column to change.
+            ids (list): Only update the payments with these ids.
+            filters (dict): Only update the payments matching these
+                customer_id, order_id, available and payment_type values.
+
+        Returns:
+            list: The ids of the updated payments.
+        """
+        cls.logger.info('Processing bulk update of %s for ids %s, filters %s',
+                        changes, ids, filters)
+        criteria = cls._filters(**(filters or {}))
+        if ids is not None:
+            criteria.append(cls.id.in_(ids))
+        if not criteria:
+            raise DataValidationError(
+                'Invalid bulk update: no ids or filters were given')
+
+        # pylint: disable=no-member
+
+        statement = cls.__table__.update().where(and_(*criteria)).values(
+            dict(changes, version=cls.version + 1))
+        if _supports_returning():
+            rows = db.session.execute(
+                statement.returning(cls.__table__.c.id)).fetchall()
+        else:
+            rows = db.session.query(cls.id).filter(*criteria).all()
+            db.session.execute(statement)
+        db.session.commit()
+
+        # pylint: enable=no-member
+
+        ids = sorted(row[0] for row in rows)
+        cls.uncache(*ids)
+        return ids
+
+    @classmethod
+    def toggle_all(cls, ids=None, filters=None):
+        """Flips the availability of many payments with one UPDATE.
+
+        Args:
+            ids (list): Only toggle the payments with these ids.
+            filters (dict): Only toggle the payments matching these
+                customer_id, order_id, available and payment_type values.
+
+        Returns:
+            list: The ids of the toggled payments.
+        """
+        return cls.update_all({'available': not_(cls.available)}, ids, filters)
+
+    @classmethod
+    def update_fields(cls, payment_id, versions=None, **changes):
+        """Changes a payment with a single UPDATE ... RETURNING.
+
+        The payment is not read first, so concurrent updates of other
+        fields are never overwritten with stale values. Every update
+        increments the version of the payment.
+
+        Args:
+            payment_id (int): The payment ID number.
+            versions (list): Only update the payment if its version is one
+                of these.
+            changes: The new value of each column to change.
+
+        Returns:
+            Payment: The updated payment, or None if there is no such payment
+                or its version did not match.
+        """
+        cls.logger.info('Updating %s with %s', payment_id, changes)
+        table = cls.__table__
+        criteria = [table.c.id == payment_id]
+        if versions is not None:
+            criteria.append(table.c.version.in_(versions))
+
+        # pylint: disable=no-member
+
+        statement = table.update().where(and_(*criteria)).values(
+            dict(changes, version=table.c.version + 1))
+        if _supports_returning():
+            row = db.session.execute(statement.returning(*table.c)).first()
+        else:
+            row = None
+            if db.session.execute(statement).rowcount:
+                row = db.session.execute(
+                    table.select().where(table.c.id == payment_id)).first()
+        db.session.commit()
+
+        # pylint: enable=no-member
+
+        if row is None:
+            return None
+        cls.uncache(payment_id)
+        return cls._attach(dict(row))
+
+    @classmethod
+    def toggle(cls, payment_id, versions=None):
+        """Flips the availability of a payment with a single UPDATE.
+
+        Args:
+            payment_id (int): The payment ID number.
+            versions (list): Only toggle the payment if its version is one
+                of these.
+
+        Returns:
+            Payment: The toggled payment, or None if there is no such payment
+                or its version did not match.
+        """
+        return cls.update_fields(
+            payment_id, versions, available=not_(cls.available))
+
+    @classmethod
+    def count_by(cls,  # pylint: disable=too-many-arguments
+                 customer_id=None,
+                 order_id=None,
+                 available=None,
+                 payment_type=None,
+                 group_by=(),
+                 info=None,
+                 fingerprint=None):
+        """Counts payments in the database with COUNT and GROUP BY.
+
+        Args:
+            group_by (tuple): Count the payments of each combination of these
+                fields, from GROUP_BY_FIELDS.
+            info (dict): Only count the payments whose info has these values.
+            fingerprint (str): Only count the payments with this fingerprint.
+
+        Returns:
+            list: A dictionary for each group, with its field values and its
+                count, ordered by the field values.
+        """
+        cls.logger.info(
+            'Processing count for customer_id %s, order_id %s,'
+            ' available %s, type %s, info %s, grouped by %s ...', customer_id,
+            order_id, available, payment_type, info, group_by)
+        columns = [getattr(cls, name) for name in group_by]
+
+        # pylint: disable=no-member
+
+        query = db.session.query(*columns, func.count(cls.id)).filter(
+            *cls._filters(customer_id, order_id, available, payment_type,
+                          info, fingerprint))
+        if columns:
+            query = query.group_by(*columns).order_by(*columns)
+
+        # pylint: enable=no-member
+
+        keys = tuple(group_by) + ('count', )
+        return [dict(zip(keys, row)) for row in query]
+
+    @classmethod
+    def find_by(cls,  # pylint: disable=too-many-arguments
+                customer_id,
+                order_id,
+                available,
+                payment_type,
+                after_id=None,
+                limit=None,
+                info=None,
+                fingerprint=None):
+        """Find payments using multiple filters.
+
+        Results are ordered by id so that they can be paged through with a
+        keyset cursor: pass the id of the last payment already seen as
+        `after_id` to get the payments that follow it.
+
+        Args:
+            after_id (int): Only return payments with a greater id.
+            limit (int): The maximum number of payments to return.
+            info (dict): Only return payments whose info has these values.
+            fingerprint (str): Only return payments with this fingerprint.
+        """
+        cls.logger.info(
+            'Processing query for customer_id %s, order_id %s,'
+            ' available %s, type %s, info %s, fingerprint %s, after_id %s,'
+            ' limit %s ...', customer_id, order_id, available, payment_type,
+            info, fingerprint, after_id, limit)
+        filter_args = cls._filters(customer_id, order_id, available,
+                                   payment_type, info, fingerprint)
+        if after_id is not None:
+            filter_args.append(cls.id > after_id)
+        query = cls.query.filter(*filter_args).order_by(cls.id)
+        if limit is not None:
+            query = query.limit(limit)
+        return query
+
+    @classmethod
+    def find_by_info(cls, key, value):
+        """Finds the payments whose info has a value, such as a paypal email.
+
+        Args:
+            key (str): The info field, e.g. 'email' or 'token'.
+            value (str): The value of the field.
+        """
+        cls.logger.info('Processing info query for %s %s ...', key, value)
+        return cls.find_by(None, None, None, None, info={key: value})
+
+
+# The GIN index behind the info @> ... lookups of find_by_info(). Only
+# Postgres has JSONB, so the index is left out on other databases.
+event.listen(
+    Payment.__table__, 'after_create',
+    DDL('CREATE INDEX ix_payment_info ON %(table)s '
+        'USING gin (info jsonb_path_ops)').execute_if(dialect='postgresql'))
+
+
+class IdempotencyKey(db.Model):
+    """
+    Remembers the response to a POST /payments with an Idempotency-Key.
+
+    A retry with the same key gets the remembered response instead of
+    creating the payment again, until the key expires after ttl seconds.
+    Keys are immutable once saved, so every worker keeps the ones it saw
+    in an in-process cache in front of the table.
+    """
+
+    logger = logging.getLogger('service.models')
+    cache = None
+    ttl = 86400
+    # How often each worker deletes the expired keys, in seconds.
+    purge_interval = 60
+    last_purge = 0.0
+
+    # Table Schema
+
+    # pylint: disable=no-member
+
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.JSON)
+    headers = db.Column(db.JSON)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    # pylint: enable=no-member
+
+    def __repr__(self):
+        return '<IdempotencyKey %r>' % self.key
+
+    def response(self):
+        """Returns the remembered response as a dictionary."""
+        return {
+            'request_hash': self.request_hash,
+            'status': self.status,
+            'body': self.body,
+            'headers': self.headers,
+            'created_at': self.created_at
+        }
+
+    @classmethod
+    def init_cache(cls, config):
+        """Sets up the key expiry and cache from an app's configuration."""
+        cls.ttl = config['IDEMPOTENCY_TTL']
+        cls.cache = LRUCache(config['IDEMPOTENCY_CACHE_SIZE'], cls.ttl)
+
+    @classmethod
+    def _expired(cls, response):
+        """Checks whether a remembered response is too old to replay."""
+        return response['created_at'] < datetime.utcnow() - timedelta(
+            seconds=cls.ttl)
+
+    @classmethod
+    def find(cls, key):
+        """Finds the response remembered for a key.
+
+        An expired key is deleted, so that it can be used again.
+
+        Args:
+            key (str): The Idempotency-Key of the request.
+
+        Returns:
+            dict: The response, or None if the key is new or expired.
+        """
+        response = cls.cache.get(key) if cls.cache is not None else None
+        if response is None:
+            record = cls.query.get(key)
+            if record is None:
+                return None
+            response = record.response()
+            if cls.cache is not None:
+                cls.cache.set(key, response)
+        if not cls._expired(response):
+            return response
+
+        cls.logger.info('Idempotency key %s expired', key)
+        if cls.cache is not None:
+            cls.cache.delete(key)
+        # pylint: disable=no-member
+        cls.query.filter(cls.key == key).delete()
+        db.session.commit()
+        return None
+
+    @classmethod
+    def save_payment(cls, key, request_hash, payment, respond):
+        """Saves a new payment and the response to its key in one transaction.
+
+        When a concurrent request with the same key commits first, the
+        payment is rolled back and that request's response is returned, so
+        that duplicates collapse to a single insert.
+
+        Args:
+            key (str): The Idempotency-Key of the request.
+            request_hash (str): Identifies the body of the request.
+            payment (Payment): The new payment.
+            respond (callable): Makes the (body, status, headers) response
+                for the saved payment.
+
+        Returns:
+            dict: The response that was remembered for the key.
+        """
+        cls.logger.info('Saving a payment for idempotency key %s', key)
+        cls.purge_expired()
+
+        # pylint: disable=no-member
+
+        db.session.add(payment)
+        db.session.flush()
+        body, status, headers = respond(payment)
+        record = cls(
+            key=key,
+            request_hash=request_hash,
+            status=status,
+            body=body,
+            headers=headers,
+            created_at=datetime.utcnow())
+        db.session.add(record)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            cls.logger.info('Idempotency key %s was saved concurrently', key)
+            return cls.find(key)
+
+        # pylint: enable=no-member
+
+        response = record.response()
+        if cls.cache is not None:
+            cls.cache.set(key, response)
+        return response
+
+    @classmethod
+    def save_payments(cls, keys, payments, request_hashes):
+        """Saves new payments and a key for each of them in one transaction.
+
+        The remembered response of each key is the saved payment, so that a
+        payment saved before under the same key can be found again.
+
+        Args:
+            keys (list): The key of each payment.
+            payments (list): The new payments.
+            request_hashes (list): Identifies the request of each payment.
+
+        Raises:
+            IntegrityError: When one of the keys was saved before. Nothing
+                is saved then.
+        """
+        cls.logger.info('Saving %s payments with idempotency keys',
+                        len(payments))
+        cls.purge_expired()
+
+        # pylint: disable=no-member
+
+        try:
+            Payment.save_all(payments, commit=False)
+            now = datetime.utcnow()
+            db.session.add_all([
+                cls(key=key,
+                    request_hash=request_hash,
+                    status=201,
+                    body=payment.serialize(),
+                    created_at=now)
+                for key, payment, request_hash in zip(keys, payments,
+                                                      request_hashes)
+            ])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        # pylint: enable=no-member
+
+        return payments
+
+    @classmethod
+    def purge_expired(cls):
+        """Deletes the expired keys, at most once per purge_interval."""
+        now = time.monotonic()
+        if now - cls.last_purge < cls.purge_interval:
+            return
+        cls.last_purge = now
+        cutoff = datetime.utcnow() - timedelta(seconds=cls.ttl)
+        # pylint: disable=no-member
+        deleted = cls.query.filter(cls.created_at < cutoff).delete()
+        db.session.commit()
+        cls.logger.info('Purged %s expired idempotency keys', deleted)
@@ -0,0 +1,86 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Database connection pool instrumentation.
+
+InstrumentedQueuePool counts how long requests wait to check out a
+connection, so the pool of each gunicorn worker can be sized from data.
+"""
+import time
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+# Engine options that only apply to a QueuePool.
+QUEUE_POOL_OPTIONS = ('pool_size', 'max_overflow', 'pool_timeout')
+
+
+class InstrumentedQueuePool(QueuePool):
+    """A QueuePool that measures how long checkouts wait for a connection.
+
+    The wait includes opening a new connection when the pool has to.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.checkout_seconds = 0.0
+        self.max_checkout_seconds = 0.0
+        self.peak_checked_out = 0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_timeouts += 1
+            raise
+        finally:
+            waited = time.monotonic() - start
+            self.checkouts += 1
+            self.checkout_seconds += waited
+            self.max_checkout_seconds = max(self.max_checkout_seconds, waited)
+        self.peak_checked_out = max(self.peak_checked_out, self.checkedout())
+        return connection
+
+    def stats(self):
+        """Returns the pool's current usage and checkout counters."""
+        return {
+            'pool': type(self).__name__,
+            'size': self.size(),
+            'max_overflow': self._max_overflow,
+            'checked_out': self.checkedout(),
+            'checked_in': self.checkedin(),
+            'overflow': max(self.overflow(), 0),
+            'peak_checked_out': self.peak_checked_out,
+            'checkouts': self.checkouts,
+            'checkout_timeouts': self.checkout_timeouts,
+            'checkout_wait_seconds_total': self.checkout_seconds,
+            'checkout_wait_seconds_max': self.max_checkout_seconds
+        }
+
+
+def pool_stats(engine):
+    """Returns the usage of an engine's connection pool.
+
+    Pools other than InstrumentedQueuePool, such as the NullPool used for
+    SQLite files, only report their class.
+    """
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {'pool': type(pool).__name__}
@@ -0,0 +1,104 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+JSON encoding for Payment Service responses.
+
+dumps() encodes to UTF-8 bytes with the fastest JSON library that is
+installed: orjson, then ujson, then the standard library json module.
+A resource can also return JSON it already encoded, as EncodedJSON.
+"""
+import json
+from flask import make_response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # pylint: disable=invalid-name
+
+try:
+    import ujson
+except ImportError:  # pragma: no cover
+    ujson = None  # pylint: disable=invalid-name
+
+
+def _orjson_dumps(data):
+    """Encodes data with orjson.
+
+    Keys that are not strings, such as the integer response codes of the
+    Swagger spec, are encoded as strings like the standard library does.
+    That option makes every dict slower to encode, so it is only used when
+    the data needs it.
+    """
+    # pylint: disable=no-member
+    try:
+        return orjson.dumps(data)
+    except TypeError:
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+
+
+def _ujson_dumps(data):
+    """Encodes data with ujson."""
+    return ujson.dumps(  # pylint: disable=c-extension-no-member
+        data, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+def _json_dumps(data):
+    """Encodes data with the standard library."""
+    return json.dumps(
+        data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+ENCODERS = {'orjson': _orjson_dumps, 'ujson': _ujson_dumps, 'json': _json_dumps}
+
+# The library used by dumps().
+if orjson is not None:
+    JSON_LIBRARY = 'orjson'
+elif ujson is not None:  # pragma: no cover
+    JSON_LIBRARY = 'ujson'
+else:  # pragma: no cover
+    JSON_LIBRARY = 'json'
+
+dumps = ENCODERS[JSON_LIBRARY]  # pylint: disable=invalid-name
+
+
+class EncodedJSON:  # pylint: disable=too-few-public-methods
+    """JSON that is already encoded, which output_json() sends as it is.
+
+    Args:
+        body (bytes): The UTF-8 JSON document.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    @classmethod
+    def array(cls, items):
+        """Makes a JSON array from UTF-8 JSON values."""
+        return cls(b'[' + b','.join(items) + b']')
+
+
+def output_json(data, code, headers=None):
+    """Makes an application/json response with dumps().
+
+    Registered as the application/json representation of the API in place
+    of the one Flask-RESTPlus builds with the standard library.
+    """
+    body = data.body if isinstance(data, EncodedJSON) else dumps(data)
+    response = make_response(body, code)
+    response.mimetype = 'application/json'
+    response.headers.extend(headers or {})
+    return response
@@ -19,28 +19,65 @@ Payments Store Service.
 
 Paths:
 ------
-GET /payments - Returns a list all of the Payments
+GET /payments - Returns a page of the Payments
 GET /payments/{id} - Returns the Payment with a given id number
+GET /payments/stats - Returns counts of the Payments, grouped by fields
+GET /payments/queue/{ticket} - Returns the state of a queued Payment
 POST /payments - creates a new Payment record in the database
+POST /payments/batch - creates many Payment records in one transaction
+PATCH /payments/batch - updates or toggles many Payment records at once
 PUT /payments/{id} - updates a Payment record in the database
 DELETE /payments/{id} - deletes a Payment record in the database
+GET /metrics - Returns the service metrics in the Prometheus text format
+GET /internal/pool - Returns the database connection pool counters
 """
+# pylint: disable=too-many-lines
 
 import sys
+import time
 import uuid
+import base64
+import hashlib
+import binascii
 import logging
+import functools
 import jsonschema
-from flask import jsonify, request, make_response, abort
+from flask import (jsonify, request, make_response, abort, Response,
+                   stream_with_context, g)
 from flask_api import status  # HTTP Status Codes
 from flask_restplus import Api, Resource, reqparse, inputs
-from schemas.payment_schema import PAYMENT_SCHEMA, PAYMENT_SCHEMA_DOC
+from schemas.payment_schema import (PAYMENT_SCHEMA_DOC,
+                                    PAYMENT_BULK_UPDATE_SCHEMA,
+                                    validate_payment, validate_bulk_update)
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL.
-from service.models import Payment, DataValidationError
+from service.models import (Payment, IdempotencyKey, DataValidationError,
+                            GROUP_BY_FIELDS, INFO_FILTER_FIELDS,
+                            SERIALIZED_FIELDS, db)
+from service.pool import pool_stats
+from service import metrics, logs, compression, writebehind
+from service.representations import EncodedJSON, output_json
 
 # Import Flask application.
-from . import app  # pylint: disable=cyclic-import
+from . import app, DEFAULT_SECRET_KEY  # pylint: disable=cyclic-import
+
+# Media type for newline delimited JSON exports.
+NDJSON = 'application/x-ndjson'
+
+# Methods that only read payments, and may read them from a replica.
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+# Cookie that keeps a client that just wrote on the primary database.
+PRIMARY_COOKIE = 'payments_primary'
+
+# Header a client sends to make retries of POST /payments safe, and the
+# header that marks a response as the replay of an earlier one.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+
+# Preference of a client that accepts a 202 Accepted for POST /payments.
+RESPOND_ASYNC = 'respond-async'
 
 
 ######################################################################
@@ -74,8 +111,13 @@ api = Api(  # pylint: disable=invalid-name
     doc='/apidocs/',
     authorizations=AUTHORIZATIONS)
 
+# Encode JSON responses with the fastest JSON library installed.
+api.representation('application/json')(output_json)
+
 # Define the model so that the docs reflect what can be sent.
 PAYMENT_MODEL_DOC = api.schema_model('Payment_doc', PAYMENT_SCHEMA_DOC)
+BULK_UPDATE_MODEL_DOC = api.schema_model('Payment_bulk_update',
+                                         PAYMENT_BULK_UPDATE_SCHEMA)
 
 # Query string arguments.
 payment_args = reqparse.RequestParser()  # pylint: disable=invalid-name
@@ -93,6 +135,55 @@ payment_args.add_argument(
     help='List Payments by availability')
 payment_args.add_argument(
     'type', type=str, required=False, help='List Payments by type')
+payment_args.add_argument(
+    'email', type=str, required=False, help='List Payments by paypal email')
+payment_args.add_argument(
+    'token', type=str, required=False, help='List Payments by paypal token')
+payment_args.add_argument(
+    'fingerprint',
+    type=str,
+    required=False,
+    help='List Payments of the same card or paypal account')
+payment_args.add_argument(
+    'limit',
+    type=inputs.positive,
+    required=False,
+    help='The maximum number of Payments to return')
+payment_args.add_argument(
+    'after_id',
+    type=int,
+    required=False,
+    help='List Payments with an id greater than this one')
+payment_args.add_argument(
+    'cursor',
+    type=str,
+    required=False,
+    help='The X-Next-Cursor token returned with the previous page')
+payment_args.add_argument(
+    'fields',
+    type=str,
+    required=False,
+    help='Comma separated fields to return; id and version always are')
+
+# Query string arguments of the payment counts: the filters of the list.
+stats_args = payment_args.copy()  # pylint: disable=invalid-name
+for argument in ('limit', 'after_id', 'cursor', 'fields'):
+    stats_args.remove_argument(argument)
+stats_args.add_argument(
+    'group_by',
+    type=str,
+    required=False,
+    help='Comma separated fields to count the Payments by: {}'.format(
+        ', '.join(GROUP_BY_FIELDS)))
+
+# Query string arguments of a single payment.
+fields_args = reqparse.RequestParser()  # pylint: disable=invalid-name
+fields_args.add_argument(
+    'fields',
+    type=str,
+    required=False,
+    location='args',
+    help='Comma separated fields to return; id and version always are')
 
 
 ######################################################################
@@ -154,25 +245,143 @@ def healthcheck():
         jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
 
+######################################################################
+# Internal metrics.
+######################################################################
+@app.route('/internal/pool')
+def database_pool():
+    """Reports how this worker's database connection pool is used."""
+    return make_response(jsonify(pool_stats(db.engine)), status.HTTP_200_OK)
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Renders the metrics for Prometheus to scrape.
+
+    They are those of every worker when METRICS_DIR is set, else this
+    worker's.
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.before_request
+def start_request_timer():
+    """Notes when the request started."""
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def observe_request_time(response):
+    """Records the request latency by route, method and status."""
+    start = g.get('request_start')
+    if start is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'none'
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            (endpoint, request.method, response.status_code))
+    if metrics.SHARED is not None:
+        metrics.SHARED.write()
+    return response
+
+
+# Compress large responses for clients that accept gzip or brotli.
+app.after_request(compression.compress_response)
+
+######################################################################
+# Database session scope.
+######################################################################
+@app.teardown_request
+def remove_session(exception=None):  # pylint: disable=unused-argument
+    """Ends the database session of a request, whatever its outcome.
+
+    The app context pushed by Payment.init_db() outlives every request, so
+    the session is not removed when the request's app context is popped.
+    """
+    db.session.remove()
+
+
+def release_session(function):
+    """Ends the database session as soon as a resource method returns.
+
+    The connection goes back to the pool before the response is encoded
+    and compressed. Streamed responses still need their session, which
+    remove_session() ends once the stream is done.
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        result = function(*args, **kwargs)
+        if not (isinstance(result, Response) and result.is_streamed):
+            db.session.remove()
+        return result
+
+    return wrapper
+
+
+class SessionResource(Resource):
+    """A resource that releases its database connection early."""
+
+    method_decorators = [release_session]
+
+
+######################################################################
+# Read replica routing.
+######################################################################
+@app.before_request
+def route_reads():
+    """Sends the reads of writes, and of recent writers, to the primary."""
+    g.read_from_primary = (request.method not in READ_METHODS
+                           or PRIMARY_COOKIE in request.cookies)
+
+
+@app.after_request
+def stick_to_primary(response):
+    """Keeps a client that wrote on the primary while replicas catch up."""
+    if (app.config['READ_REPLICA_BINDS']
+            and request.method not in READ_METHODS
+            and response.status_code < 400):
+        response.set_cookie(
+            PRIMARY_COOKIE,
+            '1',
+            max_age=app.config['PRIMARY_STICKY_SECONDS'],
+            httponly=True)
+    return response
+
+
+metrics.StatsGauges('payments_db_pool', 'Database connection pool usage.',
+                    lambda: pool_stats(db.engine))
+metrics.StatsGauges(
+    'payments_cache', 'Payment cache counters.',
+    lambda: Payment.cache.stats() if Payment.cache is not None else {})
+metrics.StatsGauges(
+    'payments_write_behind', 'Payments in the write-behind queue, by state.',
+    lambda: write_queue().stats() if write_queue() is not None else {})
+
+
 ######################################################################
 #  Payment ID route.
 ######################################################################
 @api.route('/payments/<payment_id>')
 @api.param('payment_id', 'The Payment identifier')
-class PaymentResource(Resource):
+class PaymentResource(SessionResource):
     """PaymentResource class.
 
     Allows the manipulation of a single payment.
     GET /payments/{id} - Returns the identified payment.
     PUT /payments/{id} - Updates the identified payment.
     DELETE /payments/{id} -  Deletes the identified payment.
+
+    Responses carry the version of the payment as their ETag. GET honours
+    If-None-Match and PUT honours If-Match.
     """
 
     # ------------------------------------------------------------------
     # Retrieve a payment.
     # ------------------------------------------------------------------
     @api.doc('get_payment')
+    @api.expect(fields_args, validate=True)
     @api.response(404, 'Payment not found')
+    @api.response(304, 'Payment not modified')
     @api.response(200, 'Payment retrieved successfully', PAYMENT_MODEL_DOC)
     def get(self, payment_id):
         """Retrieve a single payment.
@@ -181,17 +390,30 @@ class PaymentResource(Resource):
         """
         app.logger.info(  # pylint: disable=no-member
             "Request to Retrieve a payment with id [%s]", payment_id)
-        payment = Payment.find(payment_id)
-        if not payment:
+        fields = parse_fields(fields_args.parse_args()['fields'])
+        if fields is not None:
+            result = Payment.find_fields(payment_id, fields)
+            version = result and result['version']
+        else:
+            result = Payment.find(payment_id)
+            version = result and result.version
+        if not result:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Payment with id '{}' was not found.".format(payment_id))
-        return payment.serialize(), status.HTTP_200_OK
+        # Only a complete payment gets a strong ETag that If-Match accepts.
+        headers = {'ETag': make_etag(version, weak=fields is not None)}
+        if request.if_none_match.contains_weak(str(version)):
+            return '', status.HTTP_304_NOT_MODIFIED, headers
+        if fields is not None:
+            return result, status.HTTP_200_OK, headers
+        return result.serialize(), status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # Update an existing payment.
     # ------------------------------------------------------------------
     @api.doc('update_payment')
     @api.response(404, 'Payment not found')
+    @api.response(412, 'Payment was changed since it was read')
     @api.response(400, 'The posted Payment data was not valid')
     @api.response(200, 'Payment updated successfully', PAYMENT_MODEL_DOC)
     @api.expect(PAYMENT_MODEL_DOC)
@@ -202,18 +424,19 @@ class PaymentResource(Resource):
         """
         app.logger.info('Request to Update a payment with id [%s]', payment_id)  # pylint: disable=no-member
         check_content_type('application/json')
-        payment = Payment.find(payment_id)
-        if not payment:
-            api.abort(status.HTTP_404_NOT_FOUND,
-                      "Payment with id '{}' was not found.".format(payment_id))
         app.logger.debug('Payload = %s', api.payload)  # pylint: disable=no-member
         data = api.payload
         # Still use jsonschema to validate data.
-        jsonschema.validate(data, PAYMENT_SCHEMA)
-        payment.deserialize(data)
-        payment.id = payment_id
-        payment.save()
-        return payment.serialize(), status.HTTP_200_OK
+        with metrics.VALIDATION_SECONDS.time(('payment', )):
+            validate_payment(data)
+        changes = Payment().deserialize(data).column_values()
+        versions = if_match_versions()
+        payment = Payment.update_fields(payment_id, versions, **changes)
+        if not payment:
+            abort_update(payment_id, versions)
+        return payment.serialize(), status.HTTP_200_OK, {
+            'ETag': make_etag(payment.version)
+        }
 
     # ------------------------------------------------------------------
     # Delete a payment.
@@ -236,7 +459,7 @@ class PaymentResource(Resource):
 #  PATH: /payments
 ######################################################################
 @api.route('/payments', strict_slashes=False)
-class PaymentCollection(Resource):
+class PaymentCollection(SessionResource):
     """ Handles all interactions with collections of Payments """
 
     # ------------------------------------------------------------------
@@ -246,7 +469,13 @@ class PaymentCollection(Resource):
     @api.expect(payment_args, validate=True)
     @api.response(200, 'Success', [PAYMENT_MODEL_DOC])
     def get(self):
-        """Returns all of the Payments."""
+        """Returns a page of the Payments.
+
+        When there are more Payments after this page, the X-Next-Cursor
+        header holds the cursor to pass back to get the next one. Clients
+        that accept application/x-ndjson get every matching Payment instead,
+        streamed one per line.
+        """
         app.logger.info('Request to list Payments...')  # pylint: disable=no-member
         args = payment_args.parse_args()
 
@@ -254,11 +483,46 @@ class PaymentCollection(Resource):
         order_id = args['order_id']
         available = args['available']
         payment_type = args['type']
+        info = info_filters(args)
+        fingerprint = args['fingerprint']
+        fields = parse_fields(args['fields']) or SERIALIZED_FIELDS
+        limit = min(args['limit'] or app.config['DEFAULT_PAGE_SIZE'],
+                    app.config['MAX_PAGE_SIZE'])
+        after_id = args['after_id']
+        if args['cursor'] is not None:
+            after_id = decode_cursor(args['cursor'])
+
+        if request_wants_ndjson():
+            payments = Payment.find_by(
+                customer_id,
+                order_id,
+                available,
+                payment_type,
+                after_id=after_id,
+                limit=args['limit'],
+                info=info,
+                fingerprint=fingerprint)
+            return Response(
+                stream_with_context(generate_ndjson(payments, fields)),
+                mimetype=NDJSON)
 
-        payments = Payment.find_by(customer_id, order_id, available,
-                                   payment_type)
-        results = [payment.serialize() for payment in payments]
-        return results, status.HTTP_200_OK
+        # Fetch one extra row to find out whether there is a next page.
+        payments = Payment.find_by(
+            customer_id,
+            order_id,
+            available,
+            payment_type,
+            after_id=after_id,
+            limit=limit + 1,
+            info=info,
+            fingerprint=fingerprint)
+        rows = list(Payment.encode_all(payments, fields=fields))
+        headers = {}
+        if len(rows) > limit:
+            rows = rows[:limit]
+            headers['X-Next-Cursor'] = encode_cursor(rows[-1][0])
+        return (EncodedJSON.array(payment for _, payment in rows),
+                status.HTTP_200_OK, headers)
 
     # ------------------------------------------------------------------
     # Create a new payment.
@@ -266,28 +530,213 @@ class PaymentCollection(Resource):
     @api.doc('create_payments')
     @api.expect(PAYMENT_MODEL_DOC)
     @api.response(400, 'The posted data was not valid')
+    @api.response(409, 'The Idempotency-Key was used with another body')
     @api.response(201, 'Payment created successfully', PAYMENT_MODEL_DOC)
     def post(self):
         """Creates a payment.
 
         This endpoint will create a payment based on the data
-        posted in the body.
+        posted in the body. When the request has an Idempotency-Key header,
+        a retry with the same key and body gets the first response back
+        instead of creating another payment. When the write-behind queue is
+        on and the request has a 'Prefer: respond-async' header, the payment
+        is queued and saved later, and the response is a 202 Accepted whose
+        Location is the status of the queued payment.
         """
         app.logger.info('Request to Create a Payment')  # pylint: disable=no-member
         check_content_type('application/json')
+        key = request.headers.get(IDEMPOTENCY_HEADER)
+        request_hash = None
+        if key is not None:
+            request_hash = hashlib.sha256(request.get_data()).hexdigest()
+            replay = find_idempotent_response(key, request_hash)
+            if replay is not None:
+                return replay
+
         payment = Payment()
         app.logger.debug('Payload = %s', api.payload)  # pylint: disable=no-member
         data = api.payload
         # Still use jsonschema to validate data.
-        jsonschema.validate(data, PAYMENT_SCHEMA)
+        with metrics.VALIDATION_SECONDS.time(('payment', )):
+            validate_payment(data)
         payment.deserialize(data)
-        payment.save()
-        app.logger.info('Payment with new id [%s] saved!', payment.id)  # pylint: disable=no-member
-        location_url = api.url_for(
-            PaymentResource, payment_id=payment.id, _external=True)
-        return payment.serialize(), status.HTTP_201_CREATED, {
-            'Location': location_url
-        }
+        if key is None and write_queue() is not None and prefers_async():
+            return enqueue_payment(data)
+        if key is None:
+            payment.save()
+            app.logger.info('Payment with new id [%s] saved!', payment.id)  # pylint: disable=no-member
+            return created_response(payment)
+
+        response = IdempotencyKey.save_payment(key, request_hash, payment,
+                                               created_response)
+        if response['request_hash'] != request_hash:
+            # A concurrent request with the same key and another body won.
+            abort_idempotency_mismatch(key)
+        app.logger.info('Payment with new id [%s] saved!', response['body']['id'])  # pylint: disable=no-member
+        return response['body'], response['status'], response['headers']
+
+
+######################################################################
+#  PATH: /payments/queue/{ticket}
+######################################################################
+@api.route('/payments/queue/<int:ticket>')
+@api.param('ticket', 'The ticket of a queued payment')
+class QueuedPaymentResource(SessionResource):
+    """Handles payments waiting in the write-behind queue."""
+
+    @api.doc('get_queued_payments')
+    @api.response(404, 'Ticket not found')
+    @api.response(303, 'The payment was saved')
+    @api.response(200, 'The payment is waiting to be saved')
+    def get(self, ticket):
+        """Returns the state of a queued payment.
+
+        Once the payment is saved the response is a 303 See Other whose
+        Location is the payment.
+        """
+        app.logger.info('Request for queued payment ticket %s', ticket)  # pylint: disable=no-member
+        queue = write_queue()
+        result = queue.status(ticket) if queue is not None else None
+        if result is None:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Ticket '{}' was not found.".format(ticket))
+        if result['status'] == writebehind.SAVED:
+            return result, status.HTTP_303_SEE_OTHER, {
+                'Location':
+                api.url_for(
+                    PaymentResource,
+                    payment_id=result['payment_id'],
+                    _external=True)
+            }
+        return result, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /payments/batch
+######################################################################
+@api.route('/payments/batch')
+class PaymentBatch(SessionResource):
+    """Creates or updates many payments at once."""
+
+    @api.doc('create_payments_batch')
+    @api.expect([PAYMENT_MODEL_DOC])
+    @api.response(400, 'The posted data was not valid')
+    @api.response(201, 'Payments created successfully')
+    def post(self):
+        """Creates a batch of payments.
+
+        This endpoint validates every payment in the posted array and, if
+        they are all valid, creates them in a single transaction. Nothing
+        is created when any payment is invalid.
+        """
+        app.logger.info('Request to Create a batch of Payments')  # pylint: disable=no-member
+        check_content_type('application/json')
+        data = api.payload
+        if not isinstance(data, list) or not data:
+            raise DataValidationError(
+                'Invalid payments: body of request must be a non-empty array')
+        if len(data) > app.config['MAX_BATCH_SIZE']:
+            raise DataValidationError(
+                'Invalid payments: at most {} payments per batch'.format(
+                    app.config['MAX_BATCH_SIZE']))
+
+        payments = []
+        errors = []
+        for position, item in enumerate(data):
+            try:
+                with metrics.VALIDATION_SECONDS.time(('payment', )):
+                    validate_payment(item)
+                payments.append(Payment().deserialize(item))
+            except jsonschema.exceptions.ValidationError as error:
+                errors.append({'index': position, 'message': error.message})
+            except DataValidationError as error:
+                errors.append({'index': position, 'message': str(error)})
+        if errors:
+            app.logger.warning('%s invalid payments in batch', len(errors))  # pylint: disable=no-member
+            return {
+                'status_code': status.HTTP_400_BAD_REQUEST,
+                'error': 'Bad Request',
+                'message': '{} of {} payments are invalid'.format(
+                    len(errors), len(data)),
+                'errors': errors
+            }, status.HTTP_400_BAD_REQUEST
+
+        Payment.save_all(payments)
+        app.logger.info('Saved a batch of %s payments', len(payments))  # pylint: disable=no-member
+        results = [{
+            'status': status.HTTP_201_CREATED,
+            'location': api.url_for(
+                PaymentResource, payment_id=payment.id, _external=True),
+            'payment': payment.serialize()
+        } for payment in payments]
+        return results, status.HTTP_201_CREATED
+
+    @api.doc('update_payments_batch')
+    @api.expect(BULK_UPDATE_MODEL_DOC)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(200, 'Payments updated successfully')
+    def patch(self):
+        """Updates a batch of payments.
+
+        This endpoint either sets the same fields on, or toggles the
+        availability of, every payment selected by a list of ids and/or a
+        filter, using a single UPDATE. It returns the ids it changed.
+        """
+        app.logger.info('Request to Update a batch of Payments')  # pylint: disable=no-member
+        check_content_type('application/json')
+        data = api.payload
+        with metrics.VALIDATION_SECONDS.time(('bulk_update', )):
+            validate_bulk_update(data)
+        ids = data.get('ids')
+        if ids is not None and len(ids) > app.config['MAX_BATCH_SIZE']:
+            raise DataValidationError(
+                'Invalid bulk update: at most {} ids per batch'.format(
+                    app.config['MAX_BATCH_SIZE']))
+        filters = dict(data.get('filter', {}))
+        if 'type' in filters:
+            filters['payment_type'] = filters.pop('type')
+
+        if data.get('toggle'):
+            updated = Payment.toggle_all(ids, filters)
+        else:
+            updated = Payment.update_all(data['set'], ids, filters)
+        app.logger.info('Updated %s payments', len(updated))  # pylint: disable=no-member
+        return {'ids': updated}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /payments/stats
+######################################################################
+@api.route('/payments/stats')
+class PaymentStats(SessionResource):
+    """Counts payments in the database."""
+
+    @api.doc('count_payments')
+    @api.expect(stats_args, validate=True)
+    @api.response(400, 'The group_by fields were not valid')
+    @api.response(200, 'Success')
+    def get(self):
+        """Counts the Payments that match the filters.
+
+        The response holds the total count and, when group_by is given, the
+        count of each combination of the group_by fields. Only the counts
+        leave the database.
+        """
+        app.logger.info('Request to count Payments...')  # pylint: disable=no-member
+        args = stats_args.parse_args()
+        group_by = parse_group_by(args['group_by'])
+        groups = Payment.count_by(
+            args['customer_id'],
+            args['order_id'],
+            args['available'],
+            args['type'],
+            group_by=group_by,
+            info=info_filters(args),
+            fingerprint=args['fingerprint'])
+        result = {'count': sum(group['count'] for group in groups)}
+        if group_by:
+            result['groups'] = groups
+        return result, status.HTTP_200_OK
 
 
 ######################################################################
@@ -295,11 +744,12 @@ class PaymentCollection(Resource):
 ######################################################################
 @api.route('/payments/<int:payments_id>/toggle')
 @api.param('payments_id', 'The Payment identifier')
-class ToggleResource(Resource):
+class ToggleResource(SessionResource):
     """Toggle action on a payment."""
 
     @api.doc('toggle_payment')
     @api.response(404, 'Payment not found')
+    @api.response(412, 'Payment was changed since it was read')
     def patch(self, payments_id):
         """Toggle payment availability.
 
@@ -307,13 +757,13 @@ class ToggleResource(Resource):
         """
         app.logger.info(  # pylint: disable=no-member
             'Request to toggle payment availability with id: %s', payments_id)
-        payment = Payment.find(payments_id)
+        versions = if_match_versions()
+        payment = Payment.toggle(payments_id, versions)
         if not payment:
-            api.abort(status.HTTP_404_NOT_FOUND,
-                      'Payment with id [{}] was not found.'.format(payments_id))
-        payment.available = not payment.available
-        payment.save()
-        return payment.serialize(), status.HTTP_200_OK
+            abort_update(payments_id, versions)
+        return payment.serialize(), status.HTTP_200_OK, {
+            'ETag': make_etag(payment.version)
+        }
 
 
 ######################################################################
@@ -334,9 +784,209 @@ def reset_payments():
 
 
 def init_db():
-    """Initializes the SQLAlchemy app."""
+    """Initializes the SQLAlchemy app and the write-behind queue."""
     global app  # pylint: disable=global-statement, invalid-name
     Payment.init_db(app)
+    if write_queue() is not None:
+        write_queue().stop()
+    app.extensions['write_behind'] = writebehind.create_queue(app)
+
+
+def write_queue():
+    """Returns the write-behind queue, or None if it is turned off."""
+    return app.extensions.get('write_behind')
+
+
+def prefers_async():
+    """Checks whether the client sent a 'Prefer: respond-async' header."""
+    preferences = request.headers.get('Prefer', '').split(',')
+    return RESPOND_ASYNC in (preference.split(';')[0].strip().lower()
+                             for preference in preferences)
+
+
+def enqueue_payment(data):
+    """Queues a validated payment and makes the 202 Accepted response."""
+    queue = write_queue()
+    # Start the flusher in this process, in case the worker was forked.
+    queue.start(app)
+    ticket = queue.enqueue(data)
+    app.logger.info('Payment queued with ticket [%s]', ticket)  # pylint: disable=no-member
+    location_url = api.url_for(
+        QueuedPaymentResource, ticket=ticket, _external=True)
+    return {
+        'ticket': ticket,
+        'status': writebehind.QUEUED
+    }, status.HTTP_202_ACCEPTED, {
+        'Location': location_url,
+        'Preference-Applied': RESPOND_ASYNC
+    }
+
+
+def encode_cursor(payment_id):
+    """Makes an opaque pagination cursor pointing after a payment."""
+    token = 'id:{}'.format(payment_id).encode('ascii')
+    return base64.urlsafe_b64encode(token).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Returns the payment id an opaque pagination cursor points after."""
+    try:
+        token = base64.urlsafe_b64decode(cursor.encode('ascii'))
+        prefix, payment_id = token.decode('ascii').split(':')
+        if prefix != 'id':
+            raise ValueError(prefix)
+        return int(payment_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise DataValidationError('Invalid cursor: ' + cursor)
+
+
+def make_etag(version, weak=False):
+    """Returns the ETag of a version of a payment.
+
+    Args:
+        version (int): The version of the payment.
+        weak (bool): Make a weak ETag, for a partial representation.
+    """
+    return '{}"{}"'.format('W/' if weak else '', version)
+
+
+def parse_fields(value):
+    """Parses the fields query string argument.
+
+    Returns:
+        tuple: The requested fields, in serialized order, with id and
+            version; or None when no fields were requested.
+    """
+    if not value:
+        return None
+    requested = {field.strip() for field in value.split(',') if field.strip()}
+    unknown = requested.difference(SERIALIZED_FIELDS)
+    if unknown:
+        raise DataValidationError('Invalid fields: {}'.format(', '.join(
+            sorted(unknown))))
+    requested.update(('id', 'version'))
+    return tuple(field for field in SERIALIZED_FIELDS if field in requested)
+
+
+def if_match_versions():
+    """Returns the payment versions allowed by an If-Match header.
+
+    Returns None when any version is allowed, because the header is missing
+    or is '*'.
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = []
+    for tag in request.if_match.as_set():
+        try:
+            versions.append(int(tag))
+        except ValueError:
+            pass
+    return versions
+
+
+def abort_update(payment_id, versions):
+    """Aborts an update that changed no payment.
+
+    The update failed with 412 if the payment exists but its version did not
+    match the If-Match header, and with 404 otherwise.
+    """
+    if versions is not None and Payment.find(payment_id):
+        api.abort(status.HTTP_412_PRECONDITION_FAILED,
+                  "Payment with id '{}' was changed.".format(payment_id))
+    api.abort(status.HTTP_404_NOT_FOUND,
+              "Payment with id '{}' was not found.".format(payment_id))
+
+
+def created_response(payment):
+    """Makes the 201 Created response of POST /payments for a payment."""
+    location_url = api.url_for(
+        PaymentResource, payment_id=payment.id, _external=True)
+    return payment.serialize(), status.HTTP_201_CREATED, {
+        'Location': location_url,
+        'ETag': make_etag(payment.version)
+    }
+
+
+def find_idempotent_response(key, request_hash):
+    """Finds the response to replay for a POST with an Idempotency-Key.
+
+    Args:
+        key (str): The Idempotency-Key header of the request.
+        request_hash (str): The SHA-256 of the body of the request.
+
+    Returns:
+        tuple: The remembered response, or None if the key is new.
+    """
+    if not key or len(key) > 255:
+        raise DataValidationError(
+            'Invalid {}: must be 1 to 255 characters'.format(
+                IDEMPOTENCY_HEADER))
+    response = IdempotencyKey.find(key)
+    if response is None:
+        return None
+    if response['request_hash'] != request_hash:
+        abort_idempotency_mismatch(key)
+    app.logger.info('Replaying the response to idempotency key %s', key)  # pylint: disable=no-member
+    headers = dict(response['headers'], **{REPLAYED_HEADER: 'true'})
+    return response['body'], response['status'], headers
+
+
+def abort_idempotency_mismatch(key):
+    """Aborts a POST whose Idempotency-Key was used with another body."""
+    api.abort(
+        status.HTTP_409_CONFLICT,
+        "{} '{}' was already used with another request body.".format(
+            IDEMPOTENCY_HEADER, key))
+
+
+def info_filters(args):
+    """Returns the info values to filter payments by from the parsed args."""
+    return {
+        field: args[field]
+        for field in INFO_FILTER_FIELDS if args.get(field) is not None
+    }
+
+
+def parse_group_by(value):
+    """Parses the group_by query string argument.
+
+    Returns:
+        tuple: The fields to count the payments by, in the requested order.
+    """
+    if not value:
+        return ()
+    group_by = []
+    for field in value.split(','):
+        field = field.strip()
+        if field not in GROUP_BY_FIELDS:
+            raise DataValidationError('Invalid group_by field: {}'.format(field))
+        if field not in group_by:
+            group_by.append(field)
+    return tuple(group_by)
+
+
+def request_wants_ndjson():
+    """Checks whether the client prefers newline delimited JSON."""
+    best = request.accept_mimetypes.best_match(['application/json', NDJSON])
+    return best == NDJSON
+
+
+def generate_ndjson(payments, fields=SERIALIZED_FIELDS):
+    """Yields payments as newline delimited JSON, a batch at a time.
+
+    The rows are fetched with a server side cursor, so only one batch of
+    payments is held in memory however many of them match.
+    """
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    lines = []
+    for _, payment in Payment.encode_all(payments, batch_size, fields):
+        lines.append(payment)
+        if len(lines) == batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
 
 
 def check_content_type(content_type):
@@ -348,8 +998,45 @@ def check_content_type(content_type):
     abort(415, 'Content-Type must be {}'.format(content_type))
 
 
-def initialize_logging(log_level=logging.INFO):
-    """Initialize the default logging to STDOUT."""
+def initialize_metrics():
+    """Shares the metrics of every worker through METRICS_DIR, if it is set."""
+    metrics.share(app.config['METRICS_DIR'],
+                  app.config['METRICS_WRITE_INTERVAL'])
+
+
+def check_fingerprint_key():
+    """Warns when fingerprints are keyed with SECRET_KEY.
+
+    Anyone who knows the key can tell the card number behind a fingerprint,
+    and the default SECRET_KEY is public, so outside debug and testing the
+    fingerprints should have a FINGERPRINT_KEY of their own.
+
+    Returns:
+        bool: Whether the fingerprint key is fit for production.
+    """
+    if (app.debug or app.testing
+            or app.config['FINGERPRINT_KEY'] != app.config['SECRET_KEY']):
+        return True
+    app.logger.warning(  # pylint: disable=no-member
+        'FINGERPRINT_KEY is not set, so card and paypal fingerprints are '
+        'keyed with SECRET_KEY%s. Set FINGERPRINT_KEY before saving '
+        'payments, since changing it later changes every new fingerprint.',
+        ', which is the public default'
+        if app.config['SECRET_KEY'] == DEFAULT_SECRET_KEY else '')
+    return False
+
+
+def initialize_logging(log_level=None):
+    """Initialize the default logging to STDOUT.
+
+    The records of the app logger and its children, such as service.models,
+    are queued and written by a background thread. LOG_LEVELS sets the level
+    of single loggers and LOG_SAMPLE_RATE the fraction of INFO records kept.
+
+    Args:
+        log_level: The level of the app logger, LOG_LEVEL by default.
+    """
+    log_level = log_level or app.config['LOG_LEVEL']
     if not app.debug:
         print('Setting up logging...')
         # Set up default logging for submodules to use STDOUT.
@@ -361,16 +1048,18 @@ def initialize_logging(log_level=logging.INFO):
         handler.setFormatter(logging.Formatter(fmt))
         handler.setLevel(log_level)
 
-        # Remove the Flask default handlers and use our own
+        # Remove the Flask default handlers and queue the records for our own
 
         # pylint: disable=no-member
 
         handler_list = list(app.logger.handlers)
         for log_handler in handler_list:
             app.logger.removeHandler(log_handler)
-        app.logger.addHandler(handler)
+        logs.start_queue_logging(app.logger, handler,
+                                 app.config['LOG_SAMPLE_RATE'])
         app.logger.setLevel(log_level)
         app.logger.propagate = False
+        logs.set_levels(app.config['LOG_LEVELS'])
         app.logger.info('Logging handler established')
 
         # pylint: enable=no-member
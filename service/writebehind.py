@@ -0,0 +1,454 @@
+# Copyright 2016, 2019 John Rofrano. All Rights Reserved.
+#
+# Adapted by A. Crain, A. Shirif, M. Luo, and Z. Jiang
+# for Professor Rofrano's DevOps Project.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+Write-behind queue for Payment Service.
+
+A POST /payments that prefers an asynchronous response only appends the
+validated payment to a queue in a local SQLite file and returns a ticket.
+A flusher thread in each worker takes the queued payments off in batches
+and saves each batch in one database transaction, so a slow database
+holds up the flusher instead of the requests.
+
+A payment that cannot be saved is queued again and retried after a delay
+that doubles with every retry. While the database cannot be reached, the
+payments are retried for as long as it takes. Any other error counts as an
+attempt, and a payment is failed after max_attempts. When such an error
+fails a batch, its payments are saved one at a time, so that one bad
+payment does not fail the others.
+
+A payment is saved exactly once. A worker that claims a batch renews its
+claim before each save, and only marks the tickets it still holds. Each
+payment is saved with an idempotency key made of the queue and its ticket,
+so when a worker dies, or its claim expires, after the batch is committed
+but before it is marked as saved, the worker that claims the batch again
+finds the saved payments by their keys instead of saving them twice.
+"""
+import os
+import json
+import time
+import uuid
+import hashlib
+import atexit
+import sqlite3
+import logging
+import threading
+from sqlalchemy.exc import (IntegrityError, OperationalError, TimeoutError as
+                            PoolTimeoutError)
+from service.models import IdempotencyKey, Payment, db
+from service.representations import dumps
+
+# Seconds before the claim of a worker on a batch expires, and the batch
+# can be claimed by another worker.
+CLAIM_SECONDS = 60
+
+# Seconds that saved tickets can still be looked up.
+RETENTION_SECONDS = 86400
+
+# The states of a ticket.
+QUEUED = 'queued'
+FLUSHING = 'flushing'
+SAVED = 'saved'
+FAILED = 'failed'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS payments_queue (
+    ticket INTEGER PRIMARY KEY AUTOINCREMENT,
+    data BLOB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    payment_id INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    retries INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    queued_at REAL NOT NULL,
+    claimed_at REAL,
+    claim_id TEXT,
+    not_before REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS payments_queue_status
+    ON payments_queue (status, ticket);
+CREATE TABLE IF NOT EXISTS payments_queue_meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Columns added since the first version of the queue file.
+_NEW_COLUMNS = {
+    'retries': 'INTEGER NOT NULL DEFAULT 0',
+    'claim_id': 'TEXT',
+    'not_before': 'REAL NOT NULL DEFAULT 0'
+}
+
+
+def is_outage(error):
+    """Checks whether an error means that the database could not be used.
+
+    Such errors say nothing about the payments, so they are not counted as
+    attempts.
+    """
+    return (isinstance(error, (OperationalError, PoolTimeoutError))
+            or getattr(error, 'connection_invalidated', False))
+
+
+class WriteBehindQueue:  # pylint: disable=too-many-instance-attributes
+    """A durable queue of payments waiting to be saved.
+
+    Args:
+        path (str): The SQLite file that holds the queue.
+        batch_size (int): The most payments saved in one transaction.
+        interval (float): Seconds the flusher waits when the queue is empty.
+        max_attempts (int): Times a payment is tried before it is failed.
+        retry_delay (float): Seconds before the first retry of a payment,
+            doubled by every retry.
+        max_retry_delay (float): The longest wait between two retries.
+    """
+
+    logger = logging.getLogger('service.writebehind')
+
+    def __init__(self,  # pylint: disable=too-many-arguments
+                 path,
+                 batch_size=500,
+                 interval=0.2,
+                 max_attempts=5,
+                 retry_delay=1.0,
+                 max_retry_delay=300.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self._local = threading.local()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self._last_purge = 0.0
+        with self._connect() as connection:
+            connection.executescript(_SCHEMA)
+            columns = {
+                row['name']
+                for row in connection.execute(
+                    'PRAGMA table_info(payments_queue)')
+            }
+            for name, definition in _NEW_COLUMNS.items():
+                if name not in columns:
+                    connection.execute(
+                        'ALTER TABLE payments_queue ADD COLUMN {} {}'.format(
+                            name, definition))
+            # Tickets start again at 1 in a new queue file, so the keys of
+            # its payments are told apart by an id of the file.
+            connection.execute(
+                'INSERT OR IGNORE INTO payments_queue_meta (name, value) '
+                "VALUES ('queue_id', ?)", (uuid.uuid4().hex, ))
+            self.queue_id = connection.execute(
+                'SELECT value FROM payments_queue_meta '
+                "WHERE name = 'queue_id'").fetchone()['value']
+
+    def _connect(self):
+        """Returns the SQLite connection of the calling thread."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            # WAL lets the flusher read while requests append, and a full
+            # sync makes an acknowledged payment survive a power loss.
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=FULL')
+            connection.row_factory = sqlite3.Row
+            self._local.connection = connection
+        return connection
+
+    def enqueue(self, data):
+        """Appends a validated payment to the queue.
+
+        Args:
+            data (dict): The payment, as posted.
+
+        Returns:
+            int: The ticket to look the payment up with.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'INSERT INTO payments_queue (data, queued_at) VALUES (?, ?)',
+                (dumps(data), time.time()))
+        return cursor.lastrowid
+
+    def status(self, ticket):
+        """Returns the state of a ticket, or None if there is no such ticket."""
+        row = self._connect().execute(
+            'SELECT ticket, status, payment_id, attempts, error '
+            'FROM payments_queue WHERE ticket = ?', (ticket, )).fetchone()
+        return dict(row) if row is not None else None
+
+    def stats(self):
+        """Returns the number of tickets in each state."""
+        rows = self._connect().execute(
+            'SELECT status, COUNT(*) FROM payments_queue GROUP BY status')
+        counts = dict.fromkeys((QUEUED, FLUSHING, SAVED, FAILED), 0)
+        counts.update(rows.fetchall())
+        return counts
+
+    def claim(self, claim_id=None):
+        """Claims the oldest batch of queued payments for this worker.
+
+        Payments waiting for their next retry are left in the queue.
+
+        Args:
+            claim_id (str): Identifies the claim, to renew it and to mark
+                the payments later.
+
+        Returns:
+            list: The (ticket, data) of each claimed payment.
+        """
+        now = time.time()
+        connection = self._connect()
+        with connection:
+            # Take the write lock first, so two workers never claim the
+            # same tickets.
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(
+                'SELECT ticket, data FROM payments_queue '
+                'WHERE (status = ? AND not_before <= ?) '
+                'OR (status = ? AND claimed_at < ?) '
+                'ORDER BY ticket LIMIT ?',
+                (QUEUED, now, FLUSHING, now - CLAIM_SECONDS,
+                 self.batch_size)).fetchall()
+            connection.executemany(
+                'UPDATE payments_queue SET status = ?, claimed_at = ?, '
+                'claim_id = ? WHERE ticket = ?',
+                [(FLUSHING, now, claim_id, row['ticket']) for row in rows])
+        return [(row['ticket'], row['data']) for row in rows]
+
+    def flush(self):
+        """Saves one batch of queued payments in a single transaction.
+
+        If the batch fails for any reason but the database, its payments
+        are saved one at a time instead.
+
+        Returns:
+            int: The number of payments saved.
+        """
+        claim_id = uuid.uuid4().hex
+        batch = self.claim(claim_id)
+        if not batch:
+            self.purge()
+            return 0
+        try:
+            payment_ids = self._save(batch)
+        except Exception as error:  # pylint: disable=broad-except
+            self.logger.warning('Could not save tickets %s-%s: %s',
+                                batch[0][0], batch[-1][0], error)
+            if is_outage(error):
+                self.release([ticket for ticket, _ in batch], claim_id, error)
+                return 0
+            if len(batch) == 1:
+                return self._recover(batch[0], claim_id, error)
+        else:
+            return self._mark_saved(batch, payment_ids, claim_id)
+        # Save the payments one at a time, so only the bad ones are retried.
+        saved = 0
+        for index, item in enumerate(batch):
+            # The batch may have taken long enough for the claim to expire,
+            # so it is renewed before each payment.
+            if not self._renew(item[0], claim_id):
+                continue
+            try:
+                payment_ids = self._save([item])
+            except Exception as error:  # pylint: disable=broad-except
+                if is_outage(error):
+                    self.release([ticket for ticket, _ in batch[index:]],
+                                 claim_id, error)
+                    break
+                self.logger.warning('Could not save ticket %s: %s', item[0],
+                                    error)
+                saved += self._recover(item, claim_id, error)
+            else:
+                saved += self._mark_saved([item], payment_ids, claim_id)
+        return saved
+
+    def key(self, ticket):
+        """Returns the idempotency key that a payment is saved with."""
+        return 'write-behind:{}:{}'.format(self.queue_id, ticket)
+
+    def _save(self, batch):
+        """Saves a batch of payments in one transaction.
+
+        Args:
+            batch (list): The (ticket, data) of each payment.
+
+        Returns:
+            list: The ids of the saved payments.
+
+        Raises:
+            IntegrityError: When one of the payments was saved before.
+        """
+        try:
+            payments = IdempotencyKey.save_payments(
+                [self.key(ticket) for ticket, _ in batch],
+                [Payment().deserialize(json.loads(data)) for _, data in batch],
+                [hashlib.sha256(data).hexdigest() for _, data in batch])
+            return [payment.id for payment in payments]
+        finally:
+            db.session.remove()
+
+    def _recover(self, item, claim_id, error):
+        """Handles a payment that could not be saved on its own.
+
+        A payment that was saved before, by a worker that did not get to
+        mark it, is marked as saved. Any other payment is released.
+
+        Returns:
+            int: 1 if the payment had been saved, otherwise 0.
+        """
+        ticket, _ = item
+        if isinstance(error, IntegrityError):
+            try:
+                response = IdempotencyKey.find(self.key(ticket))
+            finally:
+                db.session.remove()
+            if response is not None:
+                self.logger.info('Ticket %s was saved before', ticket)
+                return self._mark_saved([item], [response['body']['id']],
+                                        claim_id)
+        self.release([ticket], claim_id, error)
+        return 0
+
+    def _renew(self, ticket, claim_id):
+        """Renews the claim on a payment.
+
+        Returns:
+            bool: Whether the payment is still claimed by claim_id.
+        """
+        with self._connect() as connection:
+            cursor = connection.execute(
+                'UPDATE payments_queue SET claimed_at = ? '
+                'WHERE ticket = ? AND status = ? AND claim_id = ?',
+                (time.time(), ticket, FLUSHING, claim_id))
+        return cursor.rowcount > 0
+
+    def _mark_saved(self, batch, payment_ids, claim_id):
+        """Marks saved payments with their ids.
+
+        Payments claimed by another worker since are left to that worker,
+        which finds them saved by their keys.
+
+        Returns:
+            int: The number of payments marked as saved.
+        """
+        with self._connect() as connection:
+            marked = sum(
+                connection.execute(
+                    'UPDATE payments_queue SET status = ?, payment_id = ?, '
+                    'error = NULL WHERE ticket = ? AND status = ? '
+                    'AND claim_id = ?',
+                    (SAVED, payment_id, ticket, FLUSHING, claim_id)).rowcount
+                for (ticket, _), payment_id in zip(batch, payment_ids))
+        self.logger.info('Saved %s queued payments', marked)
+        return marked
+
+    def release(self, tickets, claim_id, error):
+        """Queues payments that could not be saved for a later retry.
+
+        Each retry waits twice as long as the one before. Unless the
+        database could not be used, the payments are failed once they have
+        been tried max_attempts times. Payments claimed by another worker
+        since are left alone.
+
+        Args:
+            tickets (list): The tickets of the payments.
+            claim_id (str): The claim the payments were taken with.
+            error (Exception): Why the payments could not be saved.
+        """
+        attempts = 0 if is_outage(error) else 1
+        with self._connect() as connection:
+            connection.executemany(
+                'UPDATE payments_queue SET attempts = attempts + ?, '
+                'retries = retries + 1, error = ?, '
+                'not_before = ? + MIN(? * (1 << MIN(retries, 30)), ?), '
+                'status = CASE WHEN attempts + ? >= ? THEN ? ELSE ? END '
+                'WHERE ticket = ? AND status = ? AND claim_id = ?',
+                [(attempts, str(error), time.time(), self.retry_delay,
+                  self.max_retry_delay, attempts, self.max_attempts, FAILED,
+                  QUEUED, ticket, FLUSHING, claim_id) for ticket in tickets])
+
+    def purge(self):
+        """Deletes old saved tickets, at most once a minute."""
+        now = time.time()
+        if now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        with self._connect() as connection:
+            connection.execute(
+                'DELETE FROM payments_queue WHERE status = ? AND queued_at < ?',
+                (SAVED, now - RETENTION_SECONDS))
+
+    def start(self, app):
+        """Starts the flusher thread of this worker, if it is not running.
+
+        Args:
+            app (Flask): The app whose database the payments are saved to.
+        """
+        if (self._thread is not None and self._pid == os.getpid()
+                and self._thread.is_alive()):
+            return
+        self._stopping.clear()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(
+            target=self._run, args=(app, ), name='write-behind', daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stops the flusher thread once it has saved the queued payments."""
+        if self._thread is None or self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self, app):
+        """Flushes the queue until the worker stops."""
+        with app.app_context():
+            while True:
+                try:
+                    flushed = self.flush()
+                except Exception:  # pylint: disable=broad-except
+                    self.logger.exception('Write-behind flush failed')
+                    flushed = 0
+                if flushed < self.batch_size:
+                    if self._stopping.is_set():
+                        return
+                    self._stopping.wait(self.interval)
+
+
+def create_queue(app):
+    """Creates the write-behind queue configured for an app and starts it.
+
+    Returns:
+        WriteBehindQueue: The queue, or None if WRITE_BEHIND_QUEUE is empty.
+    """
+    config = app.config
+    if not config['WRITE_BEHIND_QUEUE']:
+        return None
+    queue = WriteBehindQueue(
+        config['WRITE_BEHIND_QUEUE'],
+        batch_size=config['WRITE_BEHIND_BATCH_SIZE'],
+        interval=config['WRITE_BEHIND_INTERVAL'],
+        max_attempts=config['WRITE_BEHIND_MAX_ATTEMPTS'],
+        retry_delay=config['WRITE_BEHIND_RETRY_DELAY'],
+        max_retry_delay=config['WRITE_BEHIND_MAX_RETRY_DELAY'])
+    queue.start(app)
+    atexit.register(queue.stop, 10)
+    return queue
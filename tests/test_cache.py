@@ -0,0 +1,103 @@
+"""
+Test cases for the Payment caches.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import unittest
+from mock import patch
+from service.cache import LRUCache, SharedCache, DictBackend, create_cache
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for the in-process LRU cache """
+
+    def test_get_and_set(self):
+        """ Cache a value and count hits and misses """
+        cache = LRUCache()
+        self.assertIsNone(cache.get('1'))
+        cache.set('1', {'id': 1})
+        self.assertEqual(cache.get('1'), {'id': 1})
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        cache = LRUCache(maxsize=2)
+        cache.set('1', 1)
+        cache.set('2', 2)
+        cache.get('1')
+        cache.set('3', 3)
+        self.assertEqual(cache.get('1'), 1)
+        self.assertIsNone(cache.get('2'))
+        self.assertEqual(cache.get('3'), 3)
+
+    def test_expires(self):
+        """ Expire entries after their time to live """
+        cache = LRUCache(ttl=10)
+        with patch('service.cache.time.monotonic', return_value=100):
+            cache.set('1', 1)
+        with patch('service.cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('1'))
+
+    def test_delete_and_clear(self):
+        """ Delete one entry and then all of them """
+        cache = LRUCache()
+        cache.set('1', 1)
+        cache.set('2', 2)
+        cache.delete('1')
+        self.assertIsNone(cache.get('1'))
+        cache.clear()
+        self.assertIsNone(cache.get('2'))
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Test Cases for the shared cache """
+
+    def test_get_set_and_delete(self):
+        """ Cache a value in the shared backend """
+        backend = DictBackend()
+        cache = SharedCache(backend)
+        self.assertIsNone(cache.get('1'))
+        cache.set('1', {'id': 1})
+        # Another worker sees the same entry.
+        self.assertEqual(SharedCache(backend).get('1'), {'id': 1})
+        cache.delete('1')
+        self.assertIsNone(SharedCache(backend).get('1'))
+        self.assertEqual(cache.stats(), {'hits': 0, 'misses': 1})
+
+    def test_clear(self):
+        """ Clear only the entries with the cache's prefix """
+        backend = DictBackend()
+        backend.set('other', 'value')
+        cache = SharedCache(backend)
+        cache.set('1', 1)
+        cache.clear()
+        self.assertIsNone(cache.get('1'))
+        self.assertEqual(backend.get('other'), 'value')
+
+    def test_create_cache(self):
+        """ Create the configured cache """
+        config = {
+            'CACHE_TYPE': 'none',
+            'CACHE_SIZE': 10,
+            'CACHE_TTL': 5,
+            'CACHE_REDIS_URL': 'redis://localhost:6379/0'
+        }
+        self.assertIsNone(create_cache(config))
+        config['CACHE_TYPE'] = 'local'
+        self.assertIsInstance(create_cache(config), LRUCache)
+        config['CACHE_TYPE'] = 'bogus'
+        self.assertRaises(RuntimeError, create_cache, config)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+"""
+Test cases for the logging helpers.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import logging
+import unittest
+from service.logs import (SamplingFilter, parse_levels, start_queue_logging,
+                          stop_queue_logging)
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the messages it handles """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogs(unittest.TestCase):
+    """ Test Cases for the logging helpers """
+
+    def setUp(self):
+        self.logger = logging.getLogger('tests.logs')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        stop_queue_logging(self.logger)
+
+    def test_parse_levels(self):
+        """ Parse the level of each logger """
+        self.assertEqual(
+            parse_levels('service.models=warning, sqlalchemy.engine=INFO,'), {
+                'service.models': 'WARNING',
+                'sqlalchemy.engine': 'INFO'
+            })
+        self.assertEqual(parse_levels(''), {})
+        self.assertRaises(ValueError, parse_levels, 'service.models')
+        self.assertRaises(ValueError, parse_levels, '=INFO')
+
+    def test_sampling_filter(self):
+        """ Drop INFO records but keep warnings """
+        record = logging.LogRecord('tests', logging.INFO, __file__, 1, 'info',
+                                   None, None)
+        warning = logging.LogRecord('tests', logging.WARNING, __file__, 1,
+                                    'warning', None, None)
+        self.assertTrue(SamplingFilter(1.0).filter(record))
+        self.assertFalse(SamplingFilter(0.0).filter(record))
+        self.assertTrue(SamplingFilter(0.0).filter(warning))
+
+    def test_queue_logging(self):
+        """ Write queued records on the listener thread """
+        handler = ListHandler()
+        start_queue_logging(self.logger, handler)
+        self.logger.info('Finding %s', 1)
+        self.logger.debug('Not logged')
+        stop_queue_logging(self.logger)
+        self.assertEqual(handler.messages, ['Finding 1'])
+        self.assertEqual(self.logger.handlers, [])
+
+    def test_queue_logging_sampled(self):
+        """ Queue only a sample of the INFO records """
+        handler = ListHandler()
+        start_queue_logging(self.logger, handler, sample_rate=0.0)
+        for _ in range(10):
+            self.logger.info('Finding')
+        self.logger.error('Failed')
+        stop_queue_logging(self.logger)
+        self.assertEqual(handler.messages, ['Failed'])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+"""
+Test cases for the Prometheus style metrics.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import threading
+from mock import patch
+from service import metrics
+from service.metrics import Counter, Histogram, StatsGauges, REGISTRY
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for counters, histograms and gauges """
+
+    def setUp(self):
+        self.registry_size = len(REGISTRY)
+
+    def tearDown(self):
+        del REGISTRY[self.registry_size:]
+
+    def test_counter(self):
+        """ Count across threads and render the merged total """
+        counter = Counter('test_total', 'A test counter.', ('kind', ))
+        threads = [
+            threading.Thread(
+                target=lambda: [counter.inc(('a', )) for _ in range(100)])
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(('b"\\', ), 2)
+        self.assertEqual(counter.value(('a', )), 400)
+        self.assertEqual(
+            counter.render(), '# HELP test_total A test counter.\n'
+            '# TYPE test_total counter\n'
+            'test_total{kind="a"} 400\n'
+            'test_total{kind="b\\"\\\\"} 2')
+
+    def test_histogram(self):
+        """ Count observations in cumulative buckets """
+        histogram = Histogram('test_seconds', 'A test histogram.',
+                              buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 2.0):
+            histogram.observe(value)
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.count(), 5)
+        lines = histogram.render().split('\n')
+        self.assertIn('test_seconds_bucket{le="0.1"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 4', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 5', lines)
+        self.assertIn('test_seconds_count 5', lines)
+        histogram.clear()
+        self.assertEqual(histogram.count(), 0)
+
+    def test_stats_gauges(self):
+        """ Render the numbers of a stats dict as gauges """
+        gauges = StatsGauges('test_pool', 'A test pool.', lambda: {
+            'size': 5,
+            'pool': 'QueuePool'
+        })
+        self.assertEqual(
+            gauges.render(), '# HELP test_pool_size A test pool.\n'
+            '# TYPE test_pool_size gauge\n'
+            'test_pool_size 5')
+
+    def test_shared_directory(self):
+        """ Add up the metrics of every worker """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        counter = Counter('test_total', 'A test counter.', ('kind', ))
+        histogram = Histogram('test_seconds', 'A test histogram.',
+                              buckets=(1.0, ))
+        gauges = StatsGauges('test_pool', 'A test pool.', lambda: {'size': 5})
+        counter.inc(('a', ), 3)
+        histogram.observe(0.5)
+        # Another worker wrote its metrics before.
+        with open(os.path.join(directory, '1.json'), 'w') as stream:
+            json.dump({
+                'test_total': [[['a'], 2], [['b'], 1]],
+                'test_seconds': [[[], [0, 1, 2.0]]]
+            }, stream)
+        with patch.object(metrics, 'SHARED'):
+            metrics.share(directory, interval=60)
+            text = metrics.render()
+            self.assertIn('test_total{kind="a"} 5\n', text)
+            self.assertIn('test_total{kind="b"} 1\n', text)
+            self.assertIn('test_seconds_bucket{le="+Inf"} 2\n', text)
+            self.assertIn('test_seconds_sum 2.5\n', text)
+            self.assertIn('test_pool_size{worker="%s"} 5' % os.getpid(),
+                          gauges.render())
+            # Scraping wrote this worker's metrics for the others to read.
+            with open(os.path.join(directory,
+                                   '{}.json'.format(os.getpid()))) as stream:
+                self.assertEqual(json.load(stream)['test_total'],
+                                 [[['a'], 3]])
+            # Requests only write once per interval.
+            counter.inc(('a', ))
+            metrics.SHARED.write()
+            with open(os.path.join(directory,
+                                   '{}.json'.format(os.getpid()))) as stream:
+                self.assertEqual(json.load(stream)['test_total'],
+                                 [[['a'], 3]])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Test cases for the payment schema validators.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import unittest
+from copy import deepcopy
+import jsonschema
+from schemas.payment_schema import (PAYMENT_SCHEMA, validate_payment,
+                                    validate_bulk_update)
+from tests.dummy_data import DUMMY
+
+CREDIT_CARD = {
+    "order_id": 1,
+    "customer_id": 1,
+    "available": True,
+    "type": "credit card",
+    "info": DUMMY
+}
+PAYPAL = {
+    "order_id": 2,
+    "customer_id": 2,
+    "available": False,
+    "type": "paypal",
+    "info": {
+        "email": "test1@test1.com",
+        "token": "abcdefg"
+    }
+}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestPaymentSchema(unittest.TestCase):
+    """ Test Cases for the compiled payment validators """
+
+    def _assert_same_result(self, data):
+        """ Assert validate_payment agrees with jsonschema.validate """
+        try:
+            jsonschema.validate(data, PAYMENT_SCHEMA)
+        except jsonschema.exceptions.ValidationError as error:
+            with self.assertRaises(jsonschema.exceptions.ValidationError) as ctx:
+                validate_payment(data)
+            self.assertEqual(ctx.exception.message, error.message)
+        else:
+            validate_payment(data)
+
+    def test_valid_payments(self):
+        """ Accept valid credit card and paypal payments """
+        self._assert_same_result(CREDIT_CARD)
+        self._assert_same_result(PAYPAL)
+
+    def test_invalid_payments(self):
+        """ Reject the same invalid payments as the full schema """
+        wrong_info = deepcopy(CREDIT_CARD)
+        wrong_info['type'] = 'paypal'
+        bad_month = deepcopy(CREDIT_CARD)
+        bad_month['info']['expiration_month'] = 13
+        no_contact = deepcopy(PAYPAL)
+        del no_contact['info']['email']
+        bad_type = deepcopy(PAYPAL)
+        bad_type['type'] = 'cash'
+        missing = deepcopy(PAYPAL)
+        del missing['order_id']
+        for data in (wrong_info, bad_month, no_contact, bad_type, missing,
+                     'not a payment', None):
+            self._assert_same_result(data)
+
+    def test_bulk_update(self):
+        """ Validate bulk updates """
+        validate_bulk_update({'ids': [1], 'toggle': True})
+        validate_bulk_update({'filter': {'customer_id': 1},
+                              'set': {'available': False}})
+        for data in ({'toggle': True}, {'ids': [1]},
+                     {'ids': [1], 'set': {'type': 'paypal'}},
+                     {'ids': [1], 'toggle': True, 'set': {'available': True}}):
+            self.assertRaises(jsonschema.exceptions.ValidationError,
+                              validate_bulk_update, data)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -7,10 +7,16 @@ Test cases can be run with:
 
 """
 
+import re
+import json
+import time
 import unittest
 import os
-from service.models import Payment, DataValidationError, db
+import itertools
+from mock import patch
+from service.models import Payment, IdempotencyKey, DataValidationError, db
 from service import app
+from service.cache import LRUCache, SharedCache, DictBackend
 from tests.dummy_data import DUMMY
 
 DATABASE_URI = os.getenv(
@@ -20,7 +26,7 @@ DATABASE_URI = os.getenv(
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
-class TestPayments(unittest.TestCase):
+class TestPayments(unittest.TestCase):  # pylint: disable=too-many-public-methods
     """ Test Cases for Payments """
     _test_credit_card_info = DUMMY
     _test_paypal_info = {
@@ -83,6 +89,46 @@ class TestPayments(unittest.TestCase):
         payments = Payment.all()
         self.assertEqual(len(payments), 1)
 
+    def test_save_all_payments(self):
+        """ Save many payments at once """
+        payments = [
+            Payment(
+                order_id=1,
+                customer_id=1,
+                available=True,
+                type="credit card",
+                info=self._test_credit_card_info),
+            Payment(
+                order_id=2,
+                customer_id=2,
+                available=False,
+                type="paypal",
+                info=self._test_paypal_info)
+        ]
+        Payment.save_all(payments)
+        self.assertEqual([payment.id for payment in payments], [1, 2])
+        self._assert_equal_test_payment_1(Payment.find(1))
+        self._assert_equal_test_payment_2(Payment.find(2))
+        self.assertEqual(Payment.save_all([]), [])
+        # Every payment gets the id of its own row.
+        many = [
+            Payment(
+                order_id=order_id,
+                customer_id=order_id,
+                available=True,
+                type="paypal",
+                info=self._test_paypal_info) for order_id in range(3, 53)
+        ]
+        saved = {
+            payment.id: payment.order_id
+            for payment in Payment.save_all(many)
+        }
+        Payment.disconnect()
+        self.assertEqual(len(saved), 50)
+        for payment_id, order_id in saved.items():
+            self.assertEqual(Payment.find(payment_id).order_id, order_id)
+            self.assertEqual(Payment.find(payment_id).version, 1)
+
     def test_delete_a_payment(self):
         """ Delete a Payment """
         payment = Payment(
@@ -112,6 +158,31 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(payment_json['type'], "credit card")
         self.assertEqual(payment_json['info'], self._test_credit_card_info)
 
+    def test_serialize_all(self):
+        """ Serialize the payments of a query without loading them """
+        self._add_two_test_payments()
+        query = Payment.find_by(None, None, None, None)
+        expected = [payment.serialize() for payment in Payment.all()]
+        self.assertEqual(list(Payment.serialize_all(query)), expected)
+        self.assertEqual(
+            list(Payment.serialize_all(query, batch_size=1)), expected)
+
+    def test_encode_all(self):
+        """ Encode the payments of a query as JSON without loading them """
+        self._add_two_test_payments()
+        query = Payment.find_by(None, None, None, None)
+        expected = [payment.serialize() for payment in Payment.all()]
+        for batch_size in (None, 1):
+            encoded = list(Payment.encode_all(query, batch_size))
+            self.assertEqual([payment_id for payment_id, _ in encoded], [1, 2])
+            self.assertEqual(
+                [json.loads(payment.decode('utf-8')) for _, payment in encoded],
+                expected)
+        encoded = Payment.encode_all(
+            Payment.find_by(None, None, False, None), fields=('id', 'version'))
+        self.assertEqual([json.loads(payment.decode('utf-8'))
+                          for _, payment in encoded], [{'id': 2, 'version': 1}])
+
     def test_deserialize(self):
         """ Convert JSON to a payment object """
         data = {
@@ -166,6 +237,74 @@ class TestPayments(unittest.TestCase):
         self.assertEqual(payment.type, saved_payment.type)
         self.assertEqual(payment.info, saved_payment.info)
 
+    def test_find_a_payment_cached(self):
+        """ Find a payment through the cache """
+        for cache in (LRUCache(), SharedCache(DictBackend())):
+            Payment.cache = cache
+            try:
+                self._add_two_test_payments()
+                self._assert_equal_test_payment_1(Payment.find(1))
+                db.session.remove()
+                payment = Payment.find(1)
+                self._assert_equal_test_payment_1(payment)
+                self.assertEqual(cache.stats()['hits'], 1)
+                # Saving a cached payment writes it and invalidates it.
+                payment.available = False
+                payment.save()
+                db.session.remove()
+                self.assertEqual(Payment.find(1).available, False)
+                Payment.toggle_all(ids=[1])
+                self.assertEqual(Payment.find(1).available, True)
+                Payment.find(1).delete()
+                self.assertIsNone(Payment.find(1))
+            finally:
+                Payment.cache = None
+            Payment.disconnect()
+            Payment.remove_all()
+
+    def test_find_a_payment_cached_during_update(self):
+        """ Do not cache a payment read before a concurrent update """
+        query_class = type(Payment.query)
+        read = query_class.get
+
+        def read_then_update(query, payment_id):
+            payment = read(query, payment_id)
+            db.engine.execute(Payment.__table__.update().values(
+                available=False, version=2))
+            Payment.uncache(payment_id)
+            return payment
+
+        for cache in (LRUCache(), SharedCache(DictBackend())):
+            Payment.cache = cache
+            try:
+                self._add_two_test_payments()
+                stale = Payment.find(1).column_values(with_id=True)
+                cache.clear()
+                db.session.remove()
+                # The find reads version 1, then the update of another
+                # worker commits and invalidates the key before it is filled.
+                with patch.object(query_class, 'get', read_then_update):
+                    self.assertEqual(Payment.find(1).version, 1)
+                self.assertIsNone(cache.get('1'))
+                db.session.remove()
+                payment = Payment.find(1)
+                self.assertEqual((payment.available, payment.version),
+                                 (False, 2))
+                # A read slower than the tombstone lives is not cached.
+                cache.add('2', stale, time.monotonic() - cache.tombstone_ttl)
+                self.assertIsNone(cache.get('2'))
+                # Once the tombstone expires, the new row is cached again.
+                cache.tombstone_ttl = 0.05
+                Payment.uncache(1)
+                time.sleep(0.1)
+                db.session.remove()
+                Payment.find(1)
+                self.assertEqual(cache.get('1')['version'], 2)
+            finally:
+                Payment.cache = None
+            Payment.disconnect()
+            Payment.remove_all()
+
     def _add_two_test_payments(self):
         Payment(
             order_id="1",
@@ -234,6 +373,255 @@ class TestPayments(unittest.TestCase):
         self.assertIsNot(payments, None)
         self._assert_equal_test_payment_2(payments[0])
 
+    def test_find_by_pages(self):
+        """ Find Payments a page at a time """
+        self._add_two_test_payments()
+        payments = Payment.find_by(None, None, None, None, limit=1).all()
+        self.assertEqual(len(payments), 1)
+        self._assert_equal_test_payment_1(payments[0])
+        payments = Payment.find_by(
+            None, None, None, None, after_id=payments[0].id, limit=1).all()
+        self.assertEqual(len(payments), 1)
+        self._assert_equal_test_payment_2(payments[0])
+        payments = Payment.find_by(
+            None, None, None, None, after_id=payments[0].id, limit=1).all()
+        self.assertEqual(payments, [])
+
+    @unittest.skipUnless(DATABASE_URI.startswith('postgres'),
+                         'EXPLAIN output is Postgres specific')
+    def test_find_by_uses_indexes(self):
+        """ Every find_by filter combination is served by an index """
+        # pylint: disable=no-member
+        self._add_two_test_payments()
+        filters = {
+            'customer_id': 1,
+            'order_id': 1,
+            'available': True,
+            'payment_type': 'credit card'
+        }
+        # The indexes that can be searched by each filter, rather than read
+        # from end to end.
+        indexes = {
+            'customer_id': {'ix_payment_customer_id_available'},
+            'order_id': {'ix_payment_order_id'},
+            'available': {'ix_payment_available_id',
+                          'ix_payment_unavailable_id'},
+            'payment_type': {'ix_payment_type_available'}
+        }
+        db.session.execute('SET enable_seqscan = off')
+        for count, available in itertools.product(
+                range(1, len(filters) + 1), (True, False)):
+            for names in itertools.combinations(filters, count):
+                args = {name: None for name in filters}
+                args.update((name, filters[name]) for name in names)
+                if 'available' in names:
+                    args['available'] = available
+                query = Payment.find_by(**args)
+                sql = query.statement.compile(
+                    dialect=db.engine.dialect,
+                    compile_kwargs={'literal_binds': True})
+                plan = '\n'.join(
+                    row[0] for row in db.session.execute('EXPLAIN ' + str(sql)))
+                self.assertNotIn('Seq Scan', plan, names)
+                used = set(re.findall(r'ix_payment_\w+', plan))
+                self.assertTrue(used, (names, available))
+                self.assertLessEqual(
+                    used, set().union(*(indexes[name] for name in names)),
+                    (names, available))
+        db.session.execute('RESET enable_seqscan')
+
+    def test_update_all(self):
+        """ Update and toggle many Payments at once """
+        self._add_two_test_payments()
+        ids = Payment.update_all({'order_id': 3}, filters={'available': True})
+        self.assertEqual(ids, [1])
+        self.assertEqual(Payment.find(1).order_id, 3)
+        self.assertEqual(Payment.find(2).order_id, 2)
+        ids = Payment.toggle_all(ids=[1, 2])
+        self.assertEqual(ids, [1, 2])
+        self.assertEqual(Payment.find(1).available, False)
+        self.assertEqual(Payment.find(2).available, True)
+        self.assertRaises(DataValidationError, Payment.update_all,
+                          {'order_id': 3})
+
+    def test_update_fields(self):
+        """ Update and toggle one Payment without reading it first """
+        self._add_two_test_payments()
+        payment = Payment.update_fields(1, order_id=3, customer_id=4)
+        self.assertEqual(payment.id, 1)
+        self.assertEqual(payment.order_id, 3)
+        self.assertEqual(payment.customer_id, 4)
+        self.assertEqual(payment.available, True)
+        self.assertEqual(Payment.find(1).order_id, 3)
+        payment = Payment.toggle(2)
+        self.assertEqual(payment.available, True)
+        self.assertEqual(Payment.find(2).available, True)
+        self.assertIsNone(Payment.update_fields(3, order_id=3))
+        self.assertIsNone(Payment.toggle(3))
+
+    def test_update_versions(self):
+        """ Count the changes to a Payment in its version """
+        self._add_two_test_payments()
+        payment = Payment.find(1)
+        self.assertEqual(payment.version, 1)
+        payment.order_id = 5
+        payment.save()
+        self.assertEqual(Payment.find(1).version, 2)
+        self.assertIsNone(Payment.toggle(1, versions=[1]))
+        self.assertEqual(Payment.toggle(1, versions=[2]).version, 3)
+        Payment.update_all({'order_id': 6}, ids=[1])
+        self.assertEqual(Payment.find(1).version, 4)
+
+    def test_count_by(self):
+        """ Count Payments in the database """
+        self._add_two_test_payments()
+        Payment(
+            order_id=3,
+            customer_id=1,
+            available=True,
+            type="paypal",
+            info=self._test_paypal_info).save()
+        self.assertEqual(Payment.count_by(), [{'count': 3}])
+        self.assertEqual(
+            Payment.count_by(customer_id=1, available=True), [{'count': 2}])
+        self.assertEqual(
+            Payment.count_by(group_by=('type', )), [{
+                'type': 'credit card',
+                'count': 1
+            }, {
+                'type': 'paypal',
+                'count': 2
+            }])
+        self.assertEqual(
+            Payment.count_by(
+                payment_type='paypal', group_by=('customer_id', 'available')),
+            [{
+                'customer_id': 1,
+                'available': True,
+                'count': 1
+            }, {
+                'customer_id': 2,
+                'available': False,
+                'count': 1
+            }])
+
+    def test_find_by_info(self):
+        """ Find Payments by a field of their info """
+        self._add_two_test_payments()
+        Payment(
+            order_id=3,
+            customer_id=3,
+            available=True,
+            type="paypal",
+            info=dict(self._test_paypal_info, email="test2@test2.com")).save()
+        payments = Payment.find_by_info('email', 'test1@test1.com').all()
+        self.assertEqual(len(payments), 1)
+        self._assert_equal_test_payment_2(payments[0])
+        self.assertEqual(
+            [payment.order_id
+             for payment in Payment.find_by_info('token', 'abcdefg')], [2, 3])
+        self.assertEqual(Payment.find_by_info('email', 'nobody').count(), 0)
+        self.assertEqual(
+            Payment.find_by(None, None, True, None, info={
+                'token': 'abcdefg'
+            }).count(), 1)
+        self.assertEqual(
+            Payment.count_by(info={'email': 'test2@test2.com'}), [{
+                'count': 1
+            }])
+
+    def test_fingerprint(self):
+        """ Fingerprint the card or paypal account of a Payment """
+        data = {
+            "order_id": 1,
+            "customer_id": 1,
+            "available": True,
+            "type": "credit card",
+            "info": dict(self._test_credit_card_info,
+                         credit_card_number="1234 5678 90")
+        }
+        payment = Payment().deserialize(data)
+        self.assertEqual(len(payment.fingerprint), 64)
+        self.assertEqual(
+            payment.fingerprint,
+            Payment.make_fingerprint("credit card",
+                                     self._test_credit_card_info))
+        paypal = Payment().deserialize(
+            dict(data, type="paypal", info=self._test_paypal_info))
+        self.assertEqual(
+            paypal.fingerprint,
+            Payment.make_fingerprint("paypal", {"email": "Test1@Test1.com "}))
+        self.assertNotEqual(paypal.fingerprint, payment.fingerprint)
+        self.assertNotEqual(
+            Payment.make_fingerprint("paypal", {"token": "abcdefg"}),
+            paypal.fingerprint)
+        self.assertIsNone(Payment.make_fingerprint("paypal", {}))
+        with patch.object(Payment, 'fingerprint_key', b'another key'):
+            self.assertNotEqual(
+                Payment.make_fingerprint("credit card",
+                                         self._test_credit_card_info),
+                payment.fingerprint)
+
+        payment.save()
+        paypal.save()
+        Payment().deserialize(data).save()
+        self.assertEqual(
+            [p.id for p in Payment.find_by(
+                None, None, None, None, fingerprint=payment.fingerprint)],
+            [1, 3])
+        self.assertEqual(Payment.find(2).serialize()['fingerprint'],
+                         paypal.fingerprint)
+
+    def test_idempotency_key(self):
+        """ Save a payment once for an idempotency key """
+        IdempotencyKey.cache.clear()
+        self.assertIsNone(IdempotencyKey.find('key-1'))
+        respond = lambda payment: ({'id': payment.id}, 201, {'ETag': '"1"'})
+        payment = Payment(
+            order_id=1,
+            customer_id=1,
+            available=True,
+            type="paypal",
+            info=self._test_paypal_info)
+        response = IdempotencyKey.save_payment('key-1', 'hash', payment,
+                                               respond)
+        self.assertEqual(response['body'], {'id': payment.id})
+        self.assertEqual(response['status'], 201)
+        self.assertEqual(IdempotencyKey.find('key-1')['request_hash'], 'hash')
+        # Another worker without the key in its cache reads it from the table.
+        IdempotencyKey.cache.clear()
+        self.assertEqual(IdempotencyKey.find('key-1')['headers'],
+                         {'ETag': '"1"'})
+        # A concurrent save of the same key returns the first response.
+        IdempotencyKey.cache.clear()
+        duplicate = Payment(
+            order_id=1,
+            customer_id=1,
+            available=True,
+            type="paypal",
+            info=self._test_paypal_info)
+        response = IdempotencyKey.save_payment('key-1', 'other', duplicate,
+                                               respond)
+        self.assertEqual(response['body'], {'id': payment.id})
+        self.assertEqual(response['request_hash'], 'hash')
+        self.assertEqual(len(Payment.all()), 1)
+
+    def test_idempotency_key_expired(self):
+        """ Forget an idempotency key after its ttl """
+        IdempotencyKey.cache.clear()
+        respond = lambda payment: ({'id': payment.id}, 201, {})
+        IdempotencyKey.save_payment(
+            'key-2', 'hash',
+            Payment(
+                order_id=1,
+                customer_id=1,
+                available=True,
+                type="paypal",
+                info=self._test_paypal_info), respond)
+        with patch.object(IdempotencyKey, 'ttl', -1):
+            self.assertIsNone(IdempotencyKey.find('key-2'))
+        self.assertIsNone(IdempotencyKey.query.get('key-2'))
+
     def test_remove_all(self):
         """ Test dropping and recreating all tables in the database """
         self._add_two_test_payments()
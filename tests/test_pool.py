@@ -0,0 +1,70 @@
+"""
+Test cases for the instrumented connection pool.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import unittest
+from sqlalchemy import create_engine, exc
+from sqlalchemy.pool import NullPool
+from service.pool import InstrumentedQueuePool, pool_stats
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestInstrumentedQueuePool(unittest.TestCase):
+    """ Test Cases for InstrumentedQueuePool """
+
+    def setUp(self):
+        self.engine = create_engine(
+            'sqlite://',
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=1,
+            pool_timeout=0.01)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_counts_checkouts(self):
+        """ Count checkouts and the connections in use """
+        first = self.engine.connect()
+        second = self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['pool'], 'InstrumentedQueuePool')
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['checked_out'], 2)
+        self.assertEqual(stats['overflow'], 1)
+        first.close()
+        second.close()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['checked_out'], 0)
+        self.assertEqual(stats['peak_checked_out'], 2)
+        self.assertGreaterEqual(stats['checkout_wait_seconds_total'],
+                                stats['checkout_wait_seconds_max'])
+
+    def test_counts_timeouts(self):
+        """ Count checkouts that time out waiting for a connection """
+        connections = [self.engine.connect(), self.engine.connect()]
+        self.assertRaises(exc.TimeoutError, self.engine.connect)
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['checkout_timeouts'], 1)
+        self.assertGreaterEqual(stats['checkout_wait_seconds_max'], 0.01)
+        for connection in connections:
+            connection.close()
+
+    def test_other_pools(self):
+        """ Report only the class of other pools """
+        engine = create_engine('sqlite://', poolclass=NullPool)
+        self.assertEqual(pool_stats(engine), {'pool': 'NullPool'})
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+"""
+Test cases for the JSON representations.
+
+Test cases can be run with:
+  nosetests
+  coverage report -m
+
+"""
+
+import json
+import unittest
+from service import app
+from service.representations import (ENCODERS, JSON_LIBRARY, EncodedJSON,
+                                     dumps, output_json)
+from tests.dummy_data import DUMMY
+
+PAYMENT = {
+    'id': 1,
+    'order_id': 2,
+    'customer_id': 3,
+    'available': True,
+    'type': 'credit card',
+    'info': dict(DUMMY, card_holder_name='Zoë / Ñandú'),
+    'version': None
+}
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRepresentations(unittest.TestCase):
+    """ Test Cases for the JSON representations """
+
+    def test_encoders(self):
+        """ Encode the same JSON with every installed library """
+        for library, encode in ENCODERS.items():
+            try:
+                encoded = encode([PAYMENT])
+            except AttributeError:
+                # The library is not installed.
+                continue
+            self.assertIsInstance(encoded, bytes, library)
+            self.assertEqual(json.loads(encoded.decode('utf-8')), [PAYMENT],
+                             library)
+        self.assertIs(dumps, ENCODERS[JSON_LIBRARY])
+
+    def test_non_string_keys(self):
+        """ Encode integer keys as strings with every installed library """
+        for library, encode in ENCODERS.items():
+            try:
+                encoded = encode({200: 'OK'})
+            except AttributeError:
+                continue
+            self.assertEqual(json.loads(encoded.decode('utf-8')),
+                             {'200': 'OK'}, library)
+
+    def test_output_json_encoded(self):
+        """ Send JSON that is already encoded as it is """
+        with app.test_request_context():
+            resp = output_json(EncodedJSON.array([b'{"id":1}', b'2']), 200)
+        self.assertEqual(resp.get_data(), b'[{"id":1},2]')
+        self.assertEqual(resp.mimetype, 'application/json')
+
+    def test_output_json(self):
+        """ Make a JSON response with headers """
+        with app.test_request_context():
+            resp = output_json(PAYMENT, 201, {'ETag': '"1"'})
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.headers['ETag'], '"1"')
+        self.assertEqual(resp.get_json(), PAYMENT)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
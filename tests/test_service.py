@@ -10,12 +10,22 @@ Test cases can be run with the following:
 
 import unittest
 import os
+import gzip
+import json
 import logging
+import shutil
+import tempfile
 from flask_api import status  # HTTP Status Codes.
 from mock import patch
-from service.models import DataValidationError, db
+from flask_sqlalchemy import get_state
+from service.models import DataValidationError, IdempotencyKey, Payment, db
+from service.cache import DictBackend, SharedCache
 from service.service import internal_server_error
 import service.service as service
+from service import compression
+from service.pool import pool_stats
+from service.representations import output_json
+from service.writebehind import WriteBehindQueue
 from tests.payments_factory import PaymentsFactory
 from tests.dummy_data import DUMMY
 
@@ -74,6 +84,32 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
         resp = self.app.get('/')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+    def test_swagger(self):
+        """Serve the Swagger spec of the API."""
+        resp = self.app.get('/swagger.json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('/payments', resp.get_json()['paths'])
+
+    def test_fingerprint_key(self):
+        """Warn when the fingerprints fall back to SECRET_KEY."""
+        config = {'SECRET_KEY': 'secret', 'FINGERPRINT_KEY': 'secret'}
+        with patch.dict(service.app.config, config):
+            with self.assertLogs(service.app.logger, 'WARNING') as logs:
+                self.assertFalse(service.check_fingerprint_key())
+            self.assertIn('FINGERPRINT_KEY is not set', logs.output[0])
+            self.assertNotIn('public default', logs.output[0])
+            service.app.config['FINGERPRINT_KEY'] = 'fingerprints'
+            self.assertTrue(service.check_fingerprint_key())
+        config = {'SECRET_KEY': service.DEFAULT_SECRET_KEY,
+                  'FINGERPRINT_KEY': service.DEFAULT_SECRET_KEY,
+                  'TESTING': False}
+        with patch.dict(service.app.config, config):
+            with self.assertLogs(service.app.logger, 'WARNING') as logs:
+                self.assertFalse(service.check_fingerprint_key())
+            self.assertIn('public default', logs.output[0])
+            service.app.config['TESTING'] = True
+            self.assertTrue(service.check_fingerprint_key())
+
     def test_healthcheck(self):
         """Test healthcheck."""
         resp = self.app.get('/healthcheck')
@@ -81,6 +117,121 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
         self.assertEqual(data["status"], status.HTTP_200_OK)
         self.assertEqual(data["message"], 'Healthy')
 
+    def test_database_pool(self):
+        """Report the database connection pool usage."""
+        resp = self.app.get('/internal/pool')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        if DATABASE_URI.startswith('postgres'):
+            self.assertEqual(data['pool'], 'InstrumentedQueuePool')
+            self.assertGreater(data['checkouts'], 0)
+        else:
+            self.assertIn('pool', data)
+
+    def test_connection_released_early(self):
+        """Return the database connection before encoding the response."""
+        self._create_payments(2)
+        if 'checked_out' not in pool_stats(db.engine):
+            self.skipTest('The database has no connection queue')
+        checked_out = []
+
+        def output(data, code, headers=None):
+            checked_out.append(pool_stats(db.engine)['checked_out'])
+            return output_json(data, code, headers)
+
+        with patch.dict(service.api.representations,
+                        {'application/json': output}):
+            resp = self.app.get('/payments')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(checked_out, [0])
+        resp = self.app.get(
+            '/payments', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 2)
+        self.assertEqual(pool_stats(db.engine)['checked_out'], 0)
+
+    def _create_replica(self, **values):
+        """Adds a SQLite read replica that holds one payment."""
+        replica = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        replica.close()
+        self.addCleanup(os.remove, replica.name)
+        config = patch.dict(
+            service.app.config, {
+                'SQLALCHEMY_BINDS': {
+                    'replica_0': 'sqlite:///' + replica.name
+                },
+                'READ_REPLICA_BINDS': ['replica_0']
+            })
+        config.start()
+        self.addCleanup(config.stop)
+        engine = db.get_engine(service.app, bind='replica_0')
+        self.addCleanup(get_state(service.app).connectors.pop, 'replica_0',
+                        None)
+        self.addCleanup(engine.dispose)
+        Payment.__table__.create(engine)
+        row = dict(id=42, order_id=1, customer_id=1, available=True,
+                   type='paypal', info={}, version=1)
+        row.update(values)
+        engine.execute(Payment.__table__.insert().values(row))
+        return engine
+
+    def test_read_replicas(self):
+        """Read from a replica until the client writes."""
+        self._create_replica()
+        resp = self.app.get('/payments')
+        self.assertEqual([payment['id'] for payment in resp.get_json()], [42])
+        payment = self._create_payments(1)[0]
+        # The client that wrote now reads what it wrote.
+        resp = self.app.get('/payments')
+        self.assertEqual([payment['id'] for payment in resp.get_json()],
+                         [payment.id])
+
+    def test_read_replicas_cached(self):
+        """Do not cache payments read from a lagging replica."""
+        Payment(order_id=1, customer_id=1, available=True, type='paypal',
+                info={}).save()
+        payment_id = Payment.all()[0].id
+        Payment.disconnect()
+        self._create_replica(id=payment_id)
+        Payment.cache = SharedCache(DictBackend())
+        self.addCleanup(setattr, Payment, 'cache', None)
+        writer = service.app.test_client()
+        reader = service.app.test_client()
+        resp = writer.patch('/payments/{}/toggle'.format(payment_id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # The tombstone of the toggle expires before the replica catches up.
+        Payment.cache.clear()
+        resp = reader.get('/payments', query_string='customer_id=1')
+        self.assertEqual(resp.get_json()[0]['version'], 1)
+        # A miss reads the primary instead of the lagging replica, and
+        # caches what it read.
+        resp = reader.get('/payments/{}'.format(payment_id))
+        self.assertEqual(resp.get_json()['version'], 2)
+        self.assertEqual(Payment.cache.get(str(payment_id))['version'], 2)
+        hits = Payment.cache.stats()['hits']
+        resp = reader.get('/payments/{}'.format(payment_id))
+        self.assertEqual(resp.get_json()['version'], 2)
+        self.assertEqual(Payment.cache.stats()['hits'], hits + 1)
+        # The writer reads what it wrote from the primary, past the cache.
+        resp = writer.get('/payments/{}'.format(payment_id))
+        data = resp.get_json()
+        self.assertEqual((data['available'], data['version']), (False, 2))
+        self.assertEqual(Payment.cache.stats()['hits'], hits + 1)
+
+    def test_metrics(self):
+        """Report request, query and validation metrics."""
+        self._create_payments(1)
+        self.app.get('/payments')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        text = resp.get_data(as_text=True)
+        self.assertIn(
+            'payments_request_duration_seconds_count{endpoint='
+            '"payment_collection",method="GET",status="200"}', text)
+        self.assertIn('payments_db_query_duration_seconds_count{statement='
+                      '"SELECT"}', text)
+        self.assertIn('payments_schema_validation_duration_seconds_count{'
+                      'schema="payment"}', text)
+
     def test_get_payment_list(self):
         """Get a list of payments."""
         self._create_payments(5)
@@ -89,6 +240,93 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
         data = resp.get_json()
         self.assertEqual(len(data), 5)
 
+    def test_get_payment_list_pages(self):
+        """Page through the list of payments with a cursor."""
+        payments = self._create_payments(5)
+        resp = self.app.get('/payments', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        ids = [payment['id'] for payment in resp.get_json()]
+        while 'X-Next-Cursor' in resp.headers:
+            resp = self.app.get(
+                '/payments',
+                query_string={
+                    'limit': 2,
+                    'cursor': resp.headers['X-Next-Cursor']
+                })
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(len(resp.get_json()), 2)
+            ids.extend(payment['id'] for payment in resp.get_json())
+        self.assertEqual(ids, [payment.id for payment in payments])
+
+    def test_get_payment_list_after_id(self):
+        """Get the payments after a given id."""
+        payments = self._create_payments(3)
+        resp = self.app.get(
+            '/payments', query_string='after_id={}'.format(payments[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([payment['id'] for payment in data],
+                         [payment.id for payment in payments[1:]])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+    def test_get_payment_list_bad_cursor(self):
+        """Get a list of payments with a cursor that was not issued."""
+        resp = self.app.get('/payments', query_string='cursor=bogus')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_payment_list_ndjson(self):
+        """Stream the list of payments as newline delimited JSON."""
+        payments = self._create_payments(5)
+        with patch.dict(service.app.config, {'STREAM_BATCH_SIZE': 2}):
+            resp = self.app.get(
+                '/payments', headers={'Accept': 'application/x-ndjson'})
+            lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [payment.id for payment in payments])
+
+    def test_get_payment_list_compressed(self):
+        """Compress a list of payments for clients that accept it."""
+        self._create_payments(5)
+        patcher = patch.dict(service.app.config, {'COMPRESS_MIN_SIZE': 512})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        resp = self.app.get('/payments', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        self.assertEqual(len(json.loads(gzip.decompress(resp.data))), 5)
+        if compression.brotli is not None:
+            resp = self.app.get(
+                '/payments', headers={'Accept-Encoding': 'gzip, br'})
+            self.assertEqual(resp.headers['Content-Encoding'], 'br')
+            self.assertEqual(
+                len(json.loads(compression.brotli.decompress(resp.data))), 5)
+        # Small responses are not worth compressing.
+        resp = self.app.get(
+            '/payments?limit=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get('/payments')
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_get_payment_list_ndjson_compressed(self):
+        """Compress a stream of payments a batch at a time."""
+        payments = self._create_payments(5)
+        with patch.dict(service.app.config, {'STREAM_BATCH_SIZE': 2}):
+            resp = self.app.get(
+                '/payments',
+                headers={
+                    'Accept': 'application/x-ndjson',
+                    'Accept-Encoding': 'gzip'
+                })
+            data = resp.get_data()
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        lines = gzip.decompress(data).decode('utf-8').splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [payment.id for payment in payments])
+
     def _assert_equal_payment(self, data, payment):
         self.assertEqual(data['order_id'], payment.order_id,
                          "order_id do not match")
@@ -131,6 +369,99 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         self._assert_equal_payment(resp.get_json(), test_payment)
 
+    def test_create_payment_batch(self):
+        """Create a batch of payments."""
+        test_payments = [PaymentsFactory() for _ in range(3)]
+        resp = self.app.post(
+            '/payments/batch',
+            json=[payment.serialize() for payment in test_payments],  # pylint: disable=no-member
+            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = resp.get_json()
+        self.assertEqual(len(results), len(test_payments))
+        for result, test_payment in zip(results, test_payments):
+            self.assertEqual(result['status'], status.HTTP_201_CREATED)
+            self._assert_equal_payment(result['payment'], test_payment)
+            resp = self.app.get(
+                result['location'], content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self._assert_equal_payment(resp.get_json(), test_payment)
+
+    def test_create_payment_batch_invalid(self):
+        """Create a batch of payments where one payment is invalid."""
+        data = [PaymentsFactory().serialize() for _ in range(3)]  # pylint: disable=no-member
+        del data[1]['info']
+        resp = self.app.post(
+            '/payments/batch', json=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        errors = resp.get_json()['errors']
+        self.assertEqual([error['index'] for error in errors], [1])
+        # Make sure none of the batch was created.
+        resp = self.app.get('/payments')
+        self.assertEqual(resp.get_json(), [])
+
+    def test_create_payment_batch_not_array(self):
+        """Create a batch of payments from something other than an array."""
+        resp = self.app.post(
+            '/payments/batch',
+            json=PaymentsFactory().serialize(),  # pylint: disable=no-member
+            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_update_payment_batch(self):
+        """Update a batch of payments by id."""
+        payments = self._create_payments(3)
+        ids = [payment.id for payment in payments[:2]]
+        resp = self.app.patch(
+            '/payments/batch',
+            json={
+                'ids': ids,
+                'set': {
+                    'available': False,
+                    'order_id': 42
+                }
+            },
+            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['ids'], ids)
+        for payment in payments:
+            resp = self.app.get('/payments/{}'.format(payment.id))
+            data = resp.get_json()
+            if payment.id in ids:
+                self.assertEqual(data['available'], False)
+                self.assertEqual(data['order_id'], 42)
+            else:
+                self._assert_equal_payment(data, payment)
+
+    def test_toggle_payment_batch(self):
+        """Toggle the availability of a customer's payments."""
+        payments = self._create_payments(3)
+        resp = self.app.patch(
+            '/payments/batch',
+            json={
+                'filter': {
+                    'customer_id': payments[1].customer_id
+                },
+                'toggle': True
+            },
+            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['ids'], [payments[1].id])
+        resp = self.app.get('/payments/{}'.format(payments[1].id))
+        self.assertEqual(resp.get_json()['available'],
+                         not payments[1].available)
+
+    def test_update_payment_batch_without_selection(self):
+        """Try to update a batch of payments without ids or a filter."""
+        self._create_payments(1)
+        resp = self.app.patch(
+            '/payments/batch',
+            json={'set': {
+                'available': False
+            }},
+            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_query_by_order_id(self):
         """Get the payments with a given order id."""
         test_order_id = 1
@@ -173,6 +504,48 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
         for payment in data:
             self.assertEqual(payment['customer_id'], test_customer_id)
 
+    def test_query_by_info(self):
+        """Get the payments with a given paypal email or token."""
+        payments = []
+        for i in range(4):
+            payment = PaymentsFactory(type='paypal')
+            payment.info = dict(payment.info, email='user{}@example.com'.format(
+                i % 2), token='token{}'.format(i))
+            payments.append(payment)
+            self.app.post('/payments', json=payment.serialize())  # pylint: disable=no-member
+        resp = self.app.get('/payments', query_string={'email': 'user1@example.com'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([payment['info']['token'] for payment in resp.get_json()],
+                         ['token1', 'token3'])
+        resp = self.app.get(
+            '/payments',
+            query_string={'email': 'user1@example.com', 'token': 'token3'})
+        self.assertEqual(len(resp.get_json()), 1)
+        resp = self.app.get(
+            '/payments/stats', query_string={'email': 'user0@example.com'})
+        self.assertEqual(resp.get_json(), {'count': 2})
+
+    def test_query_by_fingerprint(self):
+        """Get the payments of the same card."""
+        payments = self._create_payments(3)
+        card = PaymentsFactory(type='credit card')
+        card.info = dict(DUMMY, credit_card_number='4111-1111-1111-1111')
+        resp = self.app.post('/payments', json=card.serialize())  # pylint: disable=no-member
+        fingerprint = resp.get_json()['fingerprint']
+        card.info['credit_card_number'] = '4111 1111 1111 1111'
+        resp = self.app.post('/payments', json=card.serialize())  # pylint: disable=no-member
+        self.assertEqual(resp.get_json()['fingerprint'], fingerprint)
+        resp = self.app.get(
+            '/payments', query_string={'fingerprint': fingerprint})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([payment['id'] for payment in resp.get_json()],
+                         [len(payments) + 1, len(payments) + 2])
+        resp = self.app.get(
+            '/payments/stats', query_string={'fingerprint': fingerprint})
+        self.assertEqual(resp.get_json(), {'count': 2})
+        resp = self.app.get('/payments', query_string={'fingerprint': 'x'})
+        self.assertEqual(resp.get_json(), [])
+
     def test_query_by_availability(self):
         """Get the payments with a given availability."""
         test_available = True
@@ -243,6 +616,165 @@ class TestPaymentsServer(unittest.TestCase):  # pylint: disable=too-many-public-
             content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
 
+    def test_get_payment_fields(self):
+        """Get only some fields of payments."""
+        payments = self._create_payments(2)
+        resp = self.app.get('/payments?fields=customer_id,available&limit=1')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [{
+            'id': payments[0].id,
+            'customer_id': payments[0].customer_id,
+            'available': payments[0].available,
+            'version': 1
+        }])
+        self.assertIn('X-Next-Cursor', resp.headers)
+        url = '/payments/{}'.format(payments[1].id)
+        resp = self.app.get(url + '?fields=type')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {
+            'id': payments[1].id,
+            'type': payments[1].type,
+            'version': 1
+        })
+        self.assertEqual(resp.headers['ETag'], 'W/"1"')
+        resp = self.app.get(
+            url + '?fields=type', headers={'If-None-Match': 'W/"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        resp = self.app.get('/payments/0?fields=type')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/payments?fields=type,secret')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('secret', resp.get_json()['message'])
+
+    def test_count_payments(self):
+        """Count payments by their fields."""
+        payments = self._create_payments(3)
+        resp = self.app.get('/payments/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), {'count': 3})
+        resp = self.app.get('/payments/stats?customer_id={}'.format(
+            payments[0].customer_id))
+        self.assertEqual(resp.get_json()['count'], 1)
+        resp = self.app.get('/payments/stats?group_by=available')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['count'], 3)
+        available = sum(1 for payment in payments if payment.available)
+        counts = {group['available']: group['count'] for group in data['groups']}
+        self.assertEqual(counts.get(True, 0), available)
+        self.assertEqual(counts.get(False, 0), 3 - available)
+        resp = self.app.get('/payments/stats?group_by=info')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_payment_not_modified(self):
+        """Get a payment again with the ETag of the last response."""
+        test_payment = self._create_payments(1)[0]
+        url = '/payments/{}'.format(test_payment.id)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers['ETag']
+        self.assertEqual(etag, '"1"')
+        self.assertEqual(resp.get_json()['version'], 1)
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertEqual(len(resp.data), 0)
+        self.app.patch(url + '/toggle')
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['ETag'], '"2"')
+
+    def test_update_payment_if_match(self):
+        """Update a payment only if it has not changed since it was read."""
+        test_payment = self._create_payments(1)[0]
+        url = '/payments/{}'.format(test_payment.id)
+        etag = self.app.get(url).headers['ETag']
+        resp = self.app.put(
+            url,
+            json=PaymentsFactory().serialize(),  # pylint: disable=no-member
+            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['ETag'], '"2"')
+        # The payment changed since the first ETag was read.
+        resp = self.app.put(
+            url,
+            json=PaymentsFactory().serialize(),  # pylint: disable=no-member
+            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.patch(url + '/toggle', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.patch(url + '/toggle', headers={'If-Match': '"2"'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['version'], 3)
+        resp = self.app.patch(
+            '/payments/0/toggle', headers={'If-Match': '"1"'})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_create_payment_idempotency_key(self):
+        """Create a payment once when a POST with an Idempotency-Key is retried."""
+        IdempotencyKey.cache.clear()
+        data = PaymentsFactory().serialize()  # pylint: disable=no-member
+        headers = {'Idempotency-Key': 'create-1'}
+        resp = self.app.post('/payments', json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('Idempotent-Replayed', resp.headers)
+        first = resp.get_json()
+        resp = self.app.post('/payments', json=data, headers=headers)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(resp.get_json(), first)
+        self.assertTrue(resp.headers['Location'].endswith(
+            '/payments/{}'.format(first['id'])))
+        self.assertEqual(len(Payment.all()), 1)
+        # The same key with another body is refused.
+        data['order_id'] = data['order_id'] + 1
+        resp = self.app.post('/payments', json=data, headers=headers)
+        self.assertEqual(resp.status_code,
+                         status.HTTP_409_CONFLICT)
+        resp = self.app.post(
+            '/payments', json=data, headers={'Idempotency-Key': 'k' * 256})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(len(Payment.all()), 1)
+
+    def test_create_payment_async(self):
+        """Queue a payment when the client prefers an asynchronous response."""
+        directory = tempfile.mkdtemp()
+        queue = WriteBehindQueue(os.path.join(directory, 'queue.db'))
+        data = PaymentsFactory().serialize()  # pylint: disable=no-member
+        try:
+            with patch.dict(service.app.extensions, {'write_behind': queue}), \
+                    patch.object(queue, 'start'):
+                resp = self.app.post(
+                    '/payments',
+                    json=data,
+                    headers={'Prefer': 'respond-async, wait=10'})
+                self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+                self.assertEqual(resp.headers['Preference-Applied'],
+                                 'respond-async')
+                self.assertEqual(resp.get_json()['status'], 'queued')
+                url = resp.headers['Location']
+                self.assertTrue(url.endswith('/payments/queue/{}'.format(
+                    resp.get_json()['ticket'])))
+                self.assertEqual(len(Payment.all()), 0)
+                resp = self.app.get(url)
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+                self.assertEqual(resp.get_json()['status'], 'queued')
+
+                queue.flush()
+                resp = self.app.get(url)
+                self.assertEqual(resp.status_code, status.HTTP_303_SEE_OTHER)
+                payment = self.app.get(resp.headers['Location']).get_json()
+                self.assertEqual(payment['order_id'], data['order_id'])
+                resp = self.app.get('/payments/queue/0')
+                self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+                # Without the preference the payment is saved at once.
+                resp = self.app.post('/payments', json=data)
+                self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        finally:
+            shutil.rmtree(directory)
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     def test_delete_payment(self):
         """Delete a payment."""
         test_payment = self._create_payments(1)[0]